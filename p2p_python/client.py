@@ -7,23 +7,29 @@ import logging
 import bjson
 import os.path
 import random
-import copy
 import queue
 import collections
 import socket
+import ipaddress
 from hashlib import sha256
-from threading import Thread, get_ident
+from binascii import hexlify
+from threading import Thread, Event, Lock, get_ident
 from nem_ed25519.base import Encryption
 from .config import C, V, Debug, PeerToPeerError
 from .core import Core
 from .utils import is_reachable
-from .tool.utils import StackDict, EventIgnition, JsonDataBase, QueueSystem
+from .tool.utils import LRUCache, EventIgnition, PeerStore, ScoreIndex, VersionTable, QueueSystem, \
+    index2bitfield, bitfield2index
 from .tool.upnpc import UpnpClient
+from .tool.chunk import ChunkStore, PackStore, RelayCache
+from .tool.dht import DHT
 
 LOCAL_IP = UpnpClient.get_localhost_ip()
 GLOBAL_IPV4 = UpnpClient.get_global_ip()
 GLOBAL_IPV6 = UpnpClient.get_global_ip_ipv6()
 STICKY_LIMIT = 2
+SCORE_SAMPLE = 10  # join候補として見るスコア上位の数
+FAIL_LIMIT = 3  # 連続してこの回数接続に失敗したpeerを消す
 
 # Constant type
 T_REQUEST = 'type/client/request'
@@ -39,15 +45,34 @@ class ClientCmd:
     GET_NEARS = 'cmd/client/get-nears'  # ピアリストを取得
     CHECK_REACHABLE = 'cmd/client/check-reachable'  # 外部からServerに到達できるかチェック
     FILE_CHECK = 'cmd/client/file-check'  # Fileが存在するかHashをチェック
+    FILE_CHECK_BATCH = 'cmd/client/file-check-batch'  # 複数のHashをまとめてチェック
     FILE_GET = 'cmd/client/file-get'  # Fileの転送を依頼
     FILE_DELETE = 'cmd/client/file-delete'  # 全ノードからFileを消去
+    FILE_BITFIELD = 'cmd/client/file-bitfield'  # share fileのchunk所持bitfieldを交換
+    FILE_HAVE = 'cmd/client/file-have'  # 新しく取得したchunkを交換相手に通知
+    DHT_FIND = 'cmd/client/dht-find'  # chunkのproviderをDHTで探す
+    DHT_STORE = 'cmd/client/dht-store'  # chunkのproviderをDHTに登録
     DIRECT_CMD = 'cmd/client/direct-cmd'  # 隣接ノードに直接CMDを打つ
 
 
+# priority class of cmd, others are C.P_NORMAL
+CONTROL_CMDS = (ClientCmd.PING_PONG, ClientCmd.GET_NEARS, ClientCmd.CHECK_REACHABLE, ClientCmd.FILE_CHECK,
+                ClientCmd.FILE_CHECK_BATCH, ClientCmd.FILE_BITFIELD, ClientCmd.FILE_HAVE,
+                ClientCmd.DHT_FIND, ClientCmd.DHT_STORE)
+BULK_CMDS = (ClientCmd.FILE_GET,)
+# 2つのpeerに送っても問題無いcmd, hedged requestに使う (ping-pongはRTTを測るので除く)
+IDEMPOTENT_CMDS = (ClientCmd.GET_PEER_INFO, ClientCmd.GET_NEARS, ClientCmd.FILE_CHECK,
+                   ClientCmd.FILE_CHECK_BATCH, ClientCmd.FILE_GET, ClientCmd.DHT_FIND)
+# 旧版のnodeは知らずに応答しないcmd、timeoutしてもpeerの失敗(warn, error rate)に数えない
+PROBE_CMDS = (ClientCmd.FILE_CHECK_BATCH, ClientCmd.FILE_BITFIELD)
+
+
 class PeerClient:
     f_stop = False
     f_finish = False
     f_running = False
+    chunk_store = None  # share_file/get_file で共有するchunkの保存先
+    relay_cache = None  # 中継したchunkの保存先, V.F_RELAY_CACHE
 
     def __init__(self, listen=15, f_local=False):
         assert V.DATA_PATH is not None, 'Setup p2p params before PeerClientClass init.'
@@ -55,9 +80,42 @@ class PeerClient:
         self.broadcast_que = QueueSystem()  # BroadcastDataが流れてくる
         self.event = EventIgnition()  # DirectCmdを受け付ける窓口
         self.__broadcast_uuid = collections.deque(maxlen=listen*20)  # Broadcastされたuuid
-        self.__user2user_route = StackDict()
-        self._result_ques = StackDict()
-        self.peers = JsonDataBase(os.path.join(V.DATA_PATH, 'peer.dat'), listen//2)  # {(host, port): header,..}
+        self.__broadcast_lock = Lock()
+        self.__broadcast_verdict = LRUCache(limit=listen*100)  # {sha256(data): bool}
+        self.__broadcast_checking = dict()  # {sha256(data): Event} 検証中
+        self.__user2user_route = LRUCache()
+        self._result_ques = LRUCache()
+        self.shares = dict()  # {share_key: [element hash,..]}
+        self.share_chunks = dict()  # {hex hash: [(share_key, index),..]}
+        self.availability = dict()  # {share_key: {user: bitfield}} bitfieldを交換したpeer
+        self.on_have = list()  # [function(share_key, user, indexes),..]
+        self.dht = DHT(V.SERVER_NAME, ttl=V.DHT_RECORD_TTL, limit=V.DHT_RECORD_LIMIT)
+        self._dht_que = queue.Queue(maxsize=C.DHT_QUEUE_SIZE)  # DHTに登録するchunk
+        self.latency = dict()  # {cmd: deque(応答時間)} hedged requestの待ち時間
+        self.hedge_stats = {'request': 0, 'hedged': 0, 'won': 0}
+        self._hedge_lock = Lock()  # send_commandを呼ぶ各threadからhedge_statsとlatencyを更新する
+        self.peers = PeerStore(os.path.join(V.DATA_PATH, 'peer.log'), listen//2,
+                               legacy_path=os.path.join(V.DATA_PATH, 'peer.dat'))  # {(host, port): header,..}
+        self.score_index = ScoreIndex(latency_weight=V.LATENCY_WEIGHT)  # stabilize用
+        self.peers_table = VersionTable(limit=V.PEER_EXCHANGE_LIMIT)  # GET_PEER_INFOの差分
+        self.nears_table = VersionTable(limit=V.PEER_EXCHANGE_LIMIT)  # GET_NEARSの差分
+        self.long_links = set()  # 遅延に関係なくランダムに選んだ接続
+        self._topology_event = Event()  # 接続が切れたらstabilizeを起こす
+        self._topology_lock = Lock()  # Join thread, connect/disconnect hookから更新する
+        self.topology = {
+            'lost_time': None,  # 接続数が目標を下回った時刻
+            'converge_time': collections.deque(maxlen=100),  # 回復にかかった時間
+            'dial_success': 0,
+            'dial_fail': 0}
+        for host_port in self.peers.keys():
+            self.score_index.add_peer(host_port)
+        self.peers.on_put.append(self.score_index.add_peer)
+        self.peers.on_remove.append(self.score_index.remove_peer)
+        self.peers.on_put.append(self.peers_table.touch)
+        self.peers.on_remove.append(self.peers_table.touch)
+        self.p2p.on_connect.append(self._connect_hook)
+        self.p2p.on_disconnect.append(self._disconnect_hook)
+        self.get_chunk_store()
         # recode traffic if f_debug true
         if Debug.F_RECODE_TRAFFIC:
             self.p2p.traffic.recode_dir = V.TMP_PATH
@@ -67,22 +125,88 @@ class PeerClient:
         self.p2p.close()
         self.f_stop = True
 
+    def _connect_hook(self, user):
+        self.nears_table.touch(user.get_host_port())
+        self.score_index.connect(user.get_host_port())
+        self.score_index.set_rtt(user.get_host_port(), user.rtt)
+        self._check_degree()
+
+    def _disconnect_hook(self, user):
+        self.nears_table.touch(user.get_host_port())
+        self.peers.put_session(user.get_host_port(), time.time() - user.connect_time, user.rtt)
+        self.score_index.disconnect(user.get_host_port())
+        self.score_index.update_neers(user.neers.keys(), ())
+        self.long_links.discard(user.get_host_port())
+        for bitfields in list(self.availability.values()):
+            bitfields.pop(user, None)
+        self._check_degree()
+        self._topology_event.set()
+
+    def put_rtt(self, user, sample):
+        user.put_rtt(sample)
+        self.score_index.set_rtt(user.get_host_port(), user.rtt)
+
+    def update_neers(self, user, items):
+        # items => GET_NEARSの応答、旧形式の全件か差分
+        old = list(user.neers)
+        items, user.neers_version = VersionTable.apply(user.neers, items)
+        user.update_neers(items)
+        if user in self.p2p.user:
+            self.score_index.update_neers(old, user.neers.keys())
+
     def start(self, s_family=socket.AF_UNSPEC, f_stabilize=True):
-        processing_que = self.p2p.core_que.create()
-        broadcast_que = queue.LifoQueue()
+        receive_que = self.p2p.core_que.create()
+        processing_que = queue.PriorityQueue(maxsize=self.p2p.listen * 100)  # core_queと同じ大きさ
+        broadcast_que = queue.Queue()
+        relay_que = queue.Queue()
+
+        def decoding():
+            # 制御メッセージが大容量データを追い越せるように優先度を付ける
+            number = 0
+            while not self.f_stop:
+                user = msg_body = None
+                try:
+                    user, msg_body = receive_que.get(timeout=1)
+                    if isinstance(msg_body, tuple):
+                        # chunk転送frame (header, chunk)
+                        item = bjson.loads(msg_body[0])
+                        item['data'] = msg_body[1]
+                    else:
+                        item = bjson.loads(msg_body)
+                    number += 1
+                    priority = self.cmd2priority(item)
+                    if priority == C.P_LOW:
+                        # 溢れたら大容量データを捨てる、要求元はtimeoutして他のpeerに頼む
+                        try:
+                            processing_que.put_nowait((priority, number, user, item))
+                        except queue.Full:
+                            logging.debug("Drop {} from {}, processing queue is full".format(item['cmd'], user.name))
+                    else:
+                        processing_que.put((priority, number, user, item))  # 空くまで受信を止める
+                except bjson.BJsonBaseError:
+                    self.p2p.remove_connection(user)
+                    logging.debug("BJsonBaseError", exc_info=Debug.P_EXCEPTION)
+                except queue.Empty:
+                    pass
+                except Exception as e:
+                    logging.debug("Decoding error, ({}, {}, {})"
+                                  .format(user.name, msg_body, e), exc_info=Debug.P_EXCEPTION)
+            logging.info("Close decoding.")
 
         def processing():
             self.threadid = get_ident()
             while not self.f_stop:
-                user = msg_body = None
+                user = item = None
                 try:
-                    user, msg_body = processing_que.get(timeout=1)
-                    item = bjson.loads(msg_body)
+                    priority, number, user, item = processing_que.get(timeout=1)
 
                     if item['type'] == T_REQUEST:
                         if item['cmd'] == ClientCmd.BROADCAST:
                             # broadcastはCheckを含む為に別スレッド
-                            broadcast_que.put((user, item))
+                            ticket = Event()
+                            broadcast_que.put((user, item, ticket))
+                            if V.F_BROADCAST_ORDERED:
+                                relay_que.put((user, item, ticket))
                         else:
                             self.type_request(user=user, item=item)
                     elif item['type'] == T_RESPONSE:
@@ -91,14 +215,11 @@ class PeerClient:
                         self.type_ack(user=user, item=item)
                     else:
                         logging.debug("Unknown type {}".format(item['type']))
-                except bjson.BJsonBaseError:
-                    self.p2p.remove_connection(user)
-                    logging.debug("BJsonBaseError", exc_info=Debug.P_EXCEPTION)
                 except queue.Empty:
                     pass
                 except Exception as e:
                     logging.debug("Processing error, ({}, {}, {})"
-                                  .format(user.name, msg_body, e), exc_info=Debug.P_EXCEPTION)
+                                  .format(user.name, item, e), exc_info=Debug.P_EXCEPTION)
             self.f_finish = True
             self.f_running = False
             logging.info("Close processing.")
@@ -107,8 +228,15 @@ class PeerClient:
             while not self.f_stop:
                 user = None
                 try:
-                    user, item = broadcast_que.get(timeout=1)
-                    self.type_request(user=user, item=item)
+                    user, item, ticket = broadcast_que.get(timeout=1)
+                    if V.F_BROADCAST_ORDERED:
+                        # 検証のみ並列に行い、中継はrelayスレッドが受信順に行う
+                        try:
+                            self._broadcast_verdict(item['data'])
+                        finally:
+                            ticket.set()
+                    else:
+                        self.type_request(user=user, item=item)
                 except queue.Empty:
                     pass
                 except Exception as e:
@@ -116,13 +244,35 @@ class PeerClient:
                                   .format(user.name, e), exc_info=Debug.P_EXCEPTION)
             logging.info("Close broadcast.")
 
+        def relay():
+            while not self.f_stop:
+                user = None
+                try:
+                    user, item, ticket = relay_que.get(timeout=1)
+                    while not ticket.wait(1):
+                        if self.f_stop:
+                            return
+                    self.type_request(user=user, item=item)
+                except queue.Empty:
+                    pass
+                except Exception as e:
+                    logging.debug("Relay error, ({}, {})"
+                                  .format(user.name, e), exc_info=Debug.P_EXCEPTION)
+            logging.info("Close relay.")
+
         self.f_running = True
         self.p2p.start(s_family)
         if f_stabilize:
             Thread(target=self.stabilize, name='Stabilize', daemon=True).start()
         # Processing
+        Thread(target=decoding, name='Decode', daemon=True).start()
         Thread(target=processing, name='Process', daemon=True).start()
-        Thread(target=broadcast, name="Broadcast", daemon=True).start()
+        for i in range(max(1, V.BROADCAST_CHECK_WORKERS)):
+            Thread(target=broadcast, name="Broadcast{}".format(i), daemon=True).start()
+        if V.F_BROADCAST_ORDERED:
+            Thread(target=relay, name="Relay", daemon=True).start()
+        if V.F_DHT:
+            Thread(target=self._dht_loop, name='DHT', daemon=True).start()
         logging.info("start user, name is {}, port is {}".format(V.SERVER_NAME, V.P2P_PORT))
 
     def type_request(self, user, item):
@@ -148,12 +298,15 @@ class PeerClient:
                 return  # already get broadcast data
             elif self._result_ques.include(item['uuid']):
                 return  # I'm broadcaster, get from ack
-            elif not self.broadcast_check(item['data']):
-                user.warn += 1
+            f_allowed = self._broadcast_verdict(item['data'])
+            with self.__broadcast_lock:
+                if item['uuid'] in self.__broadcast_uuid:
+                    return  # checked by another thread
                 self.__broadcast_uuid.append(item['uuid'])
+            if not f_allowed:
+                user.warn += 1
                 return  # not allowed broadcast data
             else:
-                self.__broadcast_uuid.append(item['uuid'])
                 self.broadcast_que.broadcast(item['data'])
                 deny_list.append(user)
                 allow_list = None
@@ -165,12 +318,13 @@ class PeerClient:
                 f_udp = True
 
         elif item['cmd'] == ClientCmd.GET_PEER_INFO:
-            # [[(host,port), header],..]
-            temperate['data'] = self.peers.data
+            # {(host,port): header,..} or 差分 {'epoch', 'version', 'full', 'add', 'remove'}
+            temperate['data'] = self.peers_table.diff(item['data'], self.peers.copy)
             allow_list.append(user)
 
         elif item['cmd'] == ClientCmd.GET_NEARS:
-            temperate['data'] = {user.get_host_port(): user.serialize() for user in self.p2p.user}
+            temperate['data'] = self.nears_table.diff(item['data'], lambda: {
+                user_.get_host_port(): user_.serialize() for user_ in self.p2p.user.copy()})
             allow_list.append(user)
 
         elif item['cmd'] == ClientCmd.CHECK_REACHABLE:
@@ -184,8 +338,7 @@ class PeerClient:
         elif item['cmd'] == ClientCmd.FILE_CHECK:
             # {'hash': hash, 'uuid': uuid}
             file_hash = item['data']['hash']
-            file_path = os.path.join(V.TMP_PATH, 'file.' + file_hash + '.dat')
-            f_existence = os.path.exists(file_path)
+            f_existence = self._have_chunk(file_hash)
             if 'uuid' in item['data']:
                 f_asked = self.__user2user_route.include(item['data']['uuid'])
             else:
@@ -193,6 +346,25 @@ class PeerClient:
             temperate['data'] = {'have': f_existence, 'asked': f_asked}
             allow_list.append(user)
 
+        elif item['cmd'] == ClientCmd.FILE_CHECK_BATCH:
+            # {'hashes': [hash,..]} or {'key': share_key, 'start': 0, 'stop': 100}
+            # => {'bitmap': bitfield} or None(知らないshare file)
+            data = item['data']
+            if 'hashes' in data:
+                hashes = data['hashes'][:C.CHECK_BATCH_SIZE]
+            elif data.get('key') in self.shares:
+                start = max(0, data.get('start', 0))
+                stop = min(start + C.CHECK_BATCH_SIZE, data.get('stop', len(self.shares[data['key']])))
+                hashes = self.shares[data['key']][start:stop]
+            else:
+                hashes = None
+            if hashes is not None:
+                temperate['data'] = {'bitmap': index2bitfield(
+                    [index for index, file_hash in enumerate(hashes) if self._have_chunk(
+                        hexlify(file_hash).decode() if isinstance(file_hash, bytes) else file_hash.lower())],
+                    len(hashes))}
+            allow_list.append(user)
+
         elif item['cmd'] == ClientCmd.FILE_GET:
             def asking():
                 # ファイル要求元のNodeに近いNode群を無視する
@@ -241,26 +413,33 @@ class PeerClient:
                     self.__user2user_route.put(uuid=item['uuid'], item=(user, hopeful))
                     from_client, data = self.send_command(ClientCmd.FILE_GET, data,
                                                           item['uuid'], user=hopeful, timeout=5)
-                    temperate['data'] = data
                     if data is None:
                         logging.debug("Asking failed from {} {}".format(hopeful.name, file_hash))
+                    elif relay_cache is not None and not relay_cache.offer(file_hash, data):
+                        logging.debug("Asking got broken file from {} {}".format(hopeful.name, file_hash))
+                        data = None
                     else:
                         logging.debug("Asking success {} {}".format(hopeful.name, file_hash))
                 except Exception as e:
                     logging.debug("Asking raised {} {} {}".format(hopeful.name, file_hash, e))
-                    temperate['data'] = None
+                    data = None
                 temperate['type'] = T_RESPONSE
-                count = self._send_msg(item=temperate, allows=[user], denys=list())
+                if data is None:
+                    count = self._send_msg(item=temperate, allows=[user], denys=list())
+                else:
+                    count = self._send_chunk(item=temperate, chunk=data, user=user)
                 logging.debug("Response file to {} {}({})".format(user.name, count, file_hash))
                 return
 
             def sending():
-                with open(file_path, mode='br') as f:
-                    raw = f.read()
+                chunk = self.get_chunk_store().view(file_hash)
+                if chunk is None and relay_cache is not None:
+                    chunk = relay_cache.view(file_hash)
+                if chunk is None:
+                    return  # evicted
                 temperate['type'] = T_RESPONSE
-                temperate['data'] = raw
                 self.__user2user_route.put(uuid=item['uuid'], item=(user, user))
-                if 0 < self._send_msg(item=temperate, allows=[user], denys=list()):
+                if 0 < self._send_chunk(item=temperate, chunk=chunk, user=user):
                     logging.debug("Send file to {} {}".format(user.name, file_hash))
                 else:
                     logging.debug("Failed send file to {} {}".format(user.name, file_hash))
@@ -270,12 +449,14 @@ class PeerClient:
             logging.debug("Asked file get by {}".format(user.name))
             file_hash = item['data']['hash']
             already_asked_user = set(item['data']['asked'])
-            file_path = os.path.join(V.TMP_PATH, 'file.' + file_hash + '.dat')
+            relay_cache = self.get_relay_cache()
             # When you have file, sending. When you don't have file, asking
-            if os.path.exists(file_path):
+            if self._have_chunk(file_hash):
                 Thread(target=sending, name='Sending', daemon=True).start()
             elif V.F_FILE_CONTINUE_ASKING:
                 # Default disable
+                if relay_cache is not None:
+                    relay_cache.touch(file_hash)
                 Thread(target=asking, name='Asking', daemon=True).start()
 
         elif item['cmd'] == ClientCmd.FILE_DELETE:
@@ -320,6 +501,53 @@ class PeerClient:
             except ValueError:
                 allow_list = list()  # No sending
 
+        elif item['cmd'] == ClientCmd.FILE_BITFIELD:
+            # {'key': share_key, 'bitfield': bitfield} => {'bitfield': bitfield} or None
+            share_key = item['data']['key']
+            if share_key in self.shares:
+                if item['data'].get('bitfield') is not None:
+                    self._put_bitfield(share_key, user, item['data']['bitfield'])
+                temperate['data'] = {'bitfield': self.get_bitfield(share_key)}
+            allow_list.append(user)
+
+        elif item['cmd'] == ClientCmd.FILE_HAVE:
+            # {'key': share_key, 'index': [index,..]}, 応答は無い
+            share_key = item['data']['key']
+            bitfields = self.availability.get(share_key)
+            if bitfields is not None and user in bitfields:
+                total = len(self.shares[share_key])
+                indexes = [index for index in item['data']['index'] if 0 <= index < total]
+                bitfield = bitfields[user]
+                for index in indexes:
+                    bitfield[index // 8] |= 0x80 >> (index % 8)
+                self._call_have(share_key, user, indexes)
+
+        elif item['cmd'] in (ClientCmd.DHT_FIND, ClientCmd.DHT_STORE):
+            # {'hash': hash, 'provider': (host, port) or None, 'path': [name,..], 'timeout': sec, 'direct': bool}
+            def routing():
+                temperate['data'] = self._dht_route(item['cmd'], data, user)
+                self._send_msg(item=temperate, allows=[user])
+
+            data = item['data']
+            if item['cmd'] == ClientCmd.DHT_STORE and not data.get('direct') and len(data.get('path', ())) == 0:
+                if not user.p2p_accept:
+                    # 外から接続できないproviderは登録しない、待たせないようにNoneで答える
+                    temperate['data'] = None
+                    self._send_msg(item=temperate, allows=[user])
+                    return
+                data['provider'] = user.get_host_port()  # 最初のhopが送信元のaddressを入れる、申告は信じない
+            if data.get('direct'):
+                # 複製, 応答は無い、自分と送信元が共にkeyに近いnodeの時だけ受け入れる
+                users = self.p2p.user.copy()
+                if self.dht.is_replica(data['hash'], users, V.DHT_REPLICA) and \
+                        self.dht.is_replica(data['hash'], users, V.DHT_REPLICA, name=user.name) and \
+                        self._is_dialable(data['provider']):
+                    self.dht.put(data['hash'], data['provider'])
+                else:
+                    logging.debug("Ignore DHT replica of {} from {}".format(data['hash'], user.name))
+            else:
+                Thread(target=routing, name='DHT', daemon=True).start()
+
         elif item['cmd'] == ClientCmd.DIRECT_CMD:
             def direct_cmd():
                 data = item['data']
@@ -349,31 +577,40 @@ class PeerClient:
         uuid = item['uuid']
         if cmd == ClientCmd.FILE_GET:
             # origin check
-            if self.__user2user_route.include(uuid):
+            try:
                 ship_from, ship_to = self.__user2user_route.get(uuid)
-                if ship_to != user:
-                    logging.debug("Origin({}) differ from ({})".format(ship_to.name, user.name))
+                ship_to = ship_to if isinstance(ship_to, tuple) else (ship_to,)  # tuple => hedged
+                if user not in ship_to:
+                    logging.debug("Origin({}) differ from ({})"
+                                  .format(','.join(user_.name for user_ in ship_to), user.name))
                     return
-        if self._result_ques.include(uuid):
+            except KeyError:
+                pass
+        try:
             que = self._result_ques.get(uuid)
             if que:
                 que.put((user, data))
             # logging.debug("Get response from {}, cmd={}, uuid={}".format(user.name, cmd, uuid))
             # logging.debug("2:Data is '{}'".format(trim_msg(str(data), 80)))
+        except KeyError:
+            pass
 
     def type_ack(self, user, item):
         cmd = item['cmd']
         data = item['data']
         uuid = item['uuid']
 
-        if self._result_ques.include(uuid):
+        try:
             que = self._result_ques.get(uuid)
             if que:
                 que.put((user, data))
             # logging.debug("Get ack from {}".format(user.name))
+        except KeyError:
+            pass
 
     def _send_msg(self, item, allows=None, denys=None, f_udp=False):
         msg_body = bjson.dumps(item)
+        priority = self.cmd2priority(item)
         if allows is None:
             allows = self.p2p.user
         if denys is None:
@@ -383,13 +620,30 @@ class PeerClient:
         for user in allows:
             if user not in denys:
                 try:
-                    self.p2p.send_msg_body(msg_body=msg_body, user=user, f_udp=f_udp)
+                    self.p2p.send_msg_body(msg_body=msg_body, user=user, f_udp=f_udp, priority=priority)
                 except Exception as e:
                     logging.debug("Failed send msg to {}, {}".format(user.name, e))
                 c += 1
         return c  # 送った送信先
 
-    def send_command(self, cmd, data=None, uuid=None, user=None, timeout=10):
+    def _send_chunk(self, item, chunk, user):
+        # item['data']の代わりにchunkを別に送る、chunk frameを知らないnodeには従来通り
+        if not user.p2p_chunk:
+            item['data'] = bytes(chunk)
+            return self._send_msg(item=item, allows=[user], denys=list())
+        try:
+            self.p2p.send_chunk_body(bjson.dumps(item), chunk, user, priority=self.cmd2priority(item))
+            return 1
+        except Exception as e:
+            logging.debug("Failed send chunk to {}, {}".format(user.name, e))
+            return 0
+
+    def send_command(self, cmd, data=None, uuid=None, user=None, timeout=10, hedge=None):
+        """
+        hedge => 応答が遅ければ同じrequestを別のpeerにも送り、先に来た応答を使う
+            None: userを指定しない時だけV.F_HEDGED_REQUESTに従う, True: 接続中の他のpeer,
+            [user,..]: 送り直す候補, IDEMPOTENT_CMDSのみ
+        """
         assert get_ident() != self.threadid, "The thread is used by p2p_python!"
         uuid = uuid if uuid else random.randint(10, 0xffffffff)
         # 1. Make template
@@ -402,6 +656,7 @@ class PeerClient:
         f_udp = False
 
         # 2. Setup allows to send nodes
+        f_chosen = user is None  # 送信先を自分で選んだ
         if len(self.p2p.user) == 0:
             raise ConnectionError('No client connection.')
         elif cmd == ClientCmd.BROADCAST:
@@ -410,12 +665,15 @@ class PeerClient:
         elif cmd == ClientCmd.FILE_DELETE:
             allows = self.p2p.user
         elif cmd == ClientCmd.FILE_GET:
-            user = user if user else random.choice(self.p2p.user)
+            user = user if user else self.p2p.choose_user()
             self.__user2user_route.put(uuid=uuid, item=(None, user))
             allows = [user]
             timeout = 5
+        elif user is None and cmd == ClientCmd.PING_PONG:
+            user = random.choice(self.p2p.user)  # 全てのpeerのRTTを測る
+            allows = [user]
         elif user is None:
-            user = random.choice(self.p2p.user)
+            user = self.p2p.choose_user()
             allows = [user]
         elif user in self.p2p.user:
             allows = [user]
@@ -423,6 +681,14 @@ class PeerClient:
             raise ConnectionError("Not found client")
         if timeout <= 0:
             raise PeerToPeerError('timeout is zero.')
+        if hedge is None:
+            hedge = V.F_HEDGED_REQUEST and f_chosen
+        if not hedge or cmd not in IDEMPOTENT_CMDS or len(allows) != 1:
+            hedge_users = list()
+        elif hedge is True:
+            hedge_users = [user_ for user_ in self.p2p.user.copy() if user_ is not allows[0]]
+        else:
+            hedge_users = [user_ for user_ in hedge if user_ is not allows[0] and user_ in self.p2p.user]
 
         # 3. Send message to a node or some nodes
         que = queue.LifoQueue()
@@ -433,16 +699,54 @@ class PeerClient:
 
         # 4. Get response
         item = None
+        start = time.time()
+        hedged_to = None
+        tracked = list(allows) if len(allows) == 1 else list()  # 応答待ち数とerror rateを記録する
+        for user_ in tracked:
+            user_.add_inflight(1)
         try:
-            user, item = que.get(timeout=timeout)
+            if len(hedge_users) > 0:
+                self._count_hedge('request')
+                delay = min(timeout, self._hedge_delay(cmd, timeout))
+                try:
+                    user, item = que.get(timeout=delay)
+                except queue.Empty:
+                    # 1つ目のpeerが遅いので2つ目にも送る、先に来た応答を使う
+                    hedged_to = self.p2p.choose_user(hedge_users)
+                    if cmd == ClientCmd.FILE_GET:
+                        self.__user2user_route.put(uuid=uuid, item=(None, (allows[0], hedged_to)))
+                    if 0 < self._send_msg(item=temperate, allows=[hedged_to]):
+                        self._count_hedge('hedged')
+                        hedged_to.add_inflight(1)
+                        tracked.append(hedged_to)
+                    logging.debug("Hedge {} to {} after {}s".format(cmd, hedged_to.name, round(delay, 3)))
+                    user, item = que.get(timeout=max(0.001, timeout - delay))
+                    if user is hedged_to:
+                        self._count_hedge('won')
+            else:
+                user, item = que.get(timeout=timeout)
+            with self._hedge_lock:
+                self.latency.setdefault(cmd, collections.deque(maxlen=100)).append(time.time() - start)
             user.warn = 0
+            if cmd == ClientCmd.PING_PONG:
+                self.put_rtt(user, time.time() - temperate['time'])
             self._result_ques.put(uuid, None)
             f_success = True
         except queue.Empty:
-            if user:
+            if user and cmd not in PROBE_CMDS:
                 user.warn += 1
             self._result_ques.put(uuid, None)
             f_success = False
+        finally:
+            for user_ in tracked:
+                user_.add_inflight(-1)
+        for user_ in tracked:
+            if user_ is user and f_success:
+                user_.put_result(True)
+            elif not f_success and cmd in PROBE_CMDS:
+                pass  # 旧版のnodeが知らないだけかもしれない
+            elif not f_success or user_ is not hedged_to:
+                user_.put_result(False)  # 応答が無い、またはhedgeした先に負けた
 
         # 5. Process response
         if f_success:
@@ -456,10 +760,33 @@ class PeerClient:
             name = user.name if user else '{}users'.format(len(allows))
             raise TimeoutError('command timeout {} {} {} {}'.format(cmd, uuid, name, data))
 
+    def _count_hedge(self, key):
+        with self._hedge_lock:
+            self.hedge_stats[key] += 1
+
+    def _hedge_delay(self, cmd, timeout):
+        # 最近の応答時間のV.HEDGE_PERCENTILE, 記録が少なければtimeoutの1/4
+        with self._hedge_lock:
+            samples = sorted(self.latency.get(cmd, ()))
+        if len(samples) < 10:
+            return max(V.HEDGE_MIN_DELAY, timeout / 4)
+        index = min(len(samples) - 1, int(len(samples) * V.HEDGE_PERCENTILE / 100))
+        return max(V.HEDGE_MIN_DELAY, samples[index])
+
+    def hedge_info(self):
+        # hedge rate => 2つ目のpeerに送った割合, win rate => 2つ目のpeerが先に応答した割合
+        with self._hedge_lock:
+            stats = dict(self.hedge_stats)
+            cmds = list(self.latency)
+        stats['hedge_rate'] = stats['hedged'] / stats['request'] if stats['request'] else 0.0
+        stats['win_rate'] = stats['won'] / stats['hedged'] if stats['hedged'] else 0.0
+        stats['delay'] = {cmd: round(self._hedge_delay(cmd, 10), 3) for cmd in cmds}
+        return stats
+
     def send_direct_cmd(self, cmd, data, user=None, uuid=None):
         if len(self.p2p.user) == 0:
             raise PeerToPeerError('No peers.')
-        user = user if user else random.choice(self.p2p.user)
+        user = user if user else self.p2p.choose_user()
         uuid = uuid if uuid else random.randint(100, 0xffffffff)
         send_data = {
             'cmd': cmd,
@@ -468,60 +795,322 @@ class PeerClient:
         dummy, item = self.send_command(ClientCmd.DIRECT_CMD, send_data, uuid, user)
         return user, item
 
-    @staticmethod
-    def share_file(data):
+    @classmethod
+    def get_chunk_store(cls):
+        if cls.chunk_store is None:
+            assert V.TMP_PATH is not None, 'Setup p2p params before use chunk store.'
+            if V.CHUNK_STORE_BACKEND == 'pack':
+                cls.chunk_store = PackStore(os.path.join(V.TMP_PATH, 'pack'), capacity=V.CHUNK_STORE_CAPACITY,
+                                            legacy_dir=V.TMP_PATH)
+            else:
+                cls.chunk_store = ChunkStore(os.path.join(V.TMP_PATH, 'chunk'), capacity=V.CHUNK_STORE_CAPACITY,
+                                             legacy_dir=V.TMP_PATH)
+        return cls.chunk_store
+
+    @classmethod
+    def get_relay_cache(cls):
+        # return RelayCache or None(無効)
+        if cls.relay_cache is None and V.F_RELAY_CACHE:
+            assert V.TMP_PATH is not None, 'Setup p2p params before use relay cache.'
+            if V.CHUNK_STORE_BACKEND == 'pack':
+                store = PackStore(os.path.join(V.TMP_PATH, 'relay-pack'), capacity=V.RELAY_CACHE_CAPACITY)
+            else:
+                store = ChunkStore(os.path.join(V.TMP_PATH, 'relay'), capacity=V.RELAY_CACHE_CAPACITY)
+            cls.relay_cache = RelayCache(store, admit=V.RELAY_CACHE_ADMIT)
+        return cls.relay_cache
+
+    def _have_chunk(self, file_hash):
+        # storeかrelay cacheにあるか
+        if file_hash in self.get_chunk_store():
+            return True
+        relay_cache = self.get_relay_cache()
+        return relay_cache is not None and file_hash in relay_cache
+
+    @classmethod
+    def share_file(cls, data, f_pin=True, file_hash=None):
+        # file_hash => 計算済みのhex hash, 並列で計算した時に二度計算しない
         assert isinstance(data, bytes), "You need input raw binary data"
         assert len(data) <= C.MAX_RECEIVE_SIZE, "Your data({}kb) exceed MAX({}kb) size."\
             .format(len(data) // 1000, C.MAX_RECEIVE_SIZE // 1000)
 
-        file_hash = sha256(data).hexdigest()
-        file_path = os.path.join(V.TMP_PATH, 'file.' + file_hash + '.dat')
-        with open(file_path, mode='bw') as f:
-            f.write(data)
+        file_hash = file_hash or sha256(data).hexdigest()
+        # 自分で共有したchunkは容量を超えても消さない
+        cls.get_chunk_store().put(file_hash, data, f_pin=f_pin)
         return file_hash
 
     def get_file(self, file_hash, only_check=False):
         file_hash = file_hash.lower()
-        file_path = os.path.join(V.TMP_PATH, 'file.' + file_hash + '.dat')
+        store = self.get_chunk_store()
         if only_check:
-            return os.path.exists(file_path)
-        elif os.path.exists(file_path):
-            with open(file_path, mode='br') as fp:
-                return fp.read()
+            return file_hash in store
+        raw = store.get(file_hash)
+        if raw is None and self.get_relay_cache() is not None:
+            raw = self.relay_cache.get(file_hash)
+        if raw is not None:
+            return raw
         else:
-            # Ask all near nodes
+            # Ask all near nodes at once
             if len(self.p2p.user) == 0:
                 raise FileReceiveError('No user found.')
-            choose_users = copy.copy(self.p2p.user)
-            random.shuffle(choose_users)
-            for user in choose_users:
-                dummy, msg = self.send_command(ClientCmd.FILE_CHECK, data={'hash': file_hash, 'uuid': 0}, user=user)
-                if msg['have']:
-                    hopeful = user
-                    break
-            else:
-                hopeful = random.choice(self.p2p.user)
+            holders = [user for user, have in self.check_files([file_hash]).items() if have[0]]
+            if len(holders) == 0 and V.F_DHT:
+                raw = self._get_from_providers(file_hash)
+                if raw is not None:
+                    return raw
+            hopeful = self.p2p.choose_user(holders or None)
+            hedge = [user for user in holders if user is not hopeful] if V.F_HEDGED_REQUEST else None
 
-            asked_nears = [user.name for user in self.p2p.user]
             logging.debug("Ask file send to {}".format(hopeful.name))
-            dummy, raw = self.send_command(
-                cmd=ClientCmd.FILE_GET, data={'hash': file_hash, 'asked': asked_nears}, user=hopeful)
-            if raw is None:
-                raise FileReceiveError('Peers send me Null data. Please retry.')
-            if sha256(raw).hexdigest() == file_hash:
-                with open(file_path, mode='bw') as f:
-                    f.write(raw)
-                return True if only_check else raw
-            else:
-                raise FileReceiveError('File hash don\'t match. Please retry.')
+            return self.request_file(file_hash, hopeful, hedge=hedge)
 
-    @staticmethod
-    def remove_file(file_hash):
+    def check_files(self, hashes, users=None, timeout=3):
+        # 全ての接続先に並列で問い合わせる, return {user: [bool,..]} 応答の無いuserは含まない
+        hashes = [bytes.fromhex(file_hash) if isinstance(file_hash, str) else file_hash for file_hash in hashes]
+        result = dict()
+
+        def check(user):
+            have = list()
+            try:
+                for start in range(0, len(hashes), C.CHECK_BATCH_SIZE):
+                    batch = hashes[start:start + C.CHECK_BATCH_SIZE]
+                    dummy, data = self.send_command(
+                        ClientCmd.FILE_CHECK_BATCH, {'hashes': batch}, user=user, timeout=timeout)
+                    indexes = set(bitfield2index(data['bitmap'], len(batch)))
+                    have.extend(index in indexes for index in range(len(batch)))
+            except TimeoutError:
+                if len(hashes) != 1:
+                    return
+                # 旧版のnode
+                try:
+                    dummy, data = self.send_command(
+                        ClientCmd.FILE_CHECK, {'hash': hexlify(hashes[0]).decode(), 'uuid': 0}, user=user, timeout=timeout)
+                    have = [data['have']]
+                except Exception:
+                    return
+            except Exception as e:
+                logging.debug("Failed check files {}, {}".format(user.name, e))
+                return
+            result[user] = have
+
+        threads = [Thread(target=check, args=(user,), name='Check', daemon=True)
+                   for user in (self.p2p.user.copy() if users is None else users)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return result
+
+    def register_share(self, elements):
+        # share fileのchunk一覧を登録し、bitfieldを交換できるようにする
+        share_key = sha256(b''.join(elements)).hexdigest()
+        if share_key not in self.shares:
+            self.shares[share_key] = list(elements)
+            self.availability[share_key] = dict()
+            for index, element in enumerate(elements):
+                self.share_chunks.setdefault(hexlify(element).decode(), list()).append((share_key, index))
+        return share_key
+
+    def get_bitfield(self, share_key):
+        store = self.get_chunk_store()
+        elements = self.shares[share_key]
+        return index2bitfield([index for index, element in enumerate(elements)
+                               if hexlify(element).decode() in store], len(elements))
+
+    def exchange_bitfield(self, share_key, user, timeout=3):
+        # return peer's bitfield or None(知らないshare file), 旧版のnodeはTimeoutError
+        data = {'key': share_key, 'bitfield': self.get_bitfield(share_key)}
+        dummy, data = self.send_command(ClientCmd.FILE_BITFIELD, data, user=user, timeout=timeout)
+        if data is None:
+            return None
+        self._put_bitfield(share_key, user, data['bitfield'])
+        return data['bitfield']
+
+    def _put_bitfield(self, share_key, user, bitfield):
+        total = len(self.shares[share_key])
+        self.availability[share_key][user] = bytearray(bitfield[:(total + 7) // 8])
+        self._call_have(share_key, user, bitfield2index(bitfield, total))
+
+    def _call_have(self, share_key, user, indexes):
+        for function in list(self.on_have):
+            try:
+                function(share_key, user, indexes)
+            except Exception as e:
+                logging.debug("on_have error {}".format(e), exc_info=True)
+
+    def _notify_have(self, file_hash):
+        # 新しく保存したchunkをbitfieldを交換したpeerに伝える
+        for share_key, index in self.share_chunks.get(file_hash, ()):
+            temperate = {
+                'type': T_REQUEST,
+                'cmd': ClientCmd.FILE_HAVE,
+                'data': {'key': share_key, 'index': [index]},
+                'time': time.time(),
+                'uuid': random.randint(10, 0xffffffff)}
+            users = [user for user in self.availability[share_key] if user in self.p2p.user]
+            if len(users) > 0:
+                self._send_msg(item=temperate, allows=users)
+
+    def request_file(self, file_hash, user, hedge=None):
+        # userにFILE_GETを送り、hashが一致したchunkを保存して返す
+        # hedge => [user,..] userが遅い時に送り直すpeer, send_command参照
+        asked_nears = [user_.name for user_ in self.p2p.user]
+        dummy, raw = self.send_command(
+            cmd=ClientCmd.FILE_GET, data={'hash': file_hash, 'asked': asked_nears}, user=user, hedge=hedge)
+        if raw is None:
+            raise FileReceiveError('Peers send me Null data. Please retry.')
+        if sha256(raw).hexdigest() != file_hash:
+            raise FileReceiveError('File hash don\'t match. Please retry.')
+        self.get_chunk_store().put(file_hash, raw)
+        self._notify_have(file_hash)
+        if V.F_DHT:
+            self.provide(file_hash)
+        return raw
+
+    def find_providers(self, file_hash, timeout=10):
+        # DHTでchunkを持つnodeを探す, return [(host, port),..]
+        self.dht.stats['find'] += 1
+        result = self._dht_route(ClientCmd.DHT_FIND, {'hash': file_hash, 'path': [], 'timeout': timeout})
+        providers = [tuple(provider) for provider in result['providers'] if provider is not None
+                     and self._is_known_peer(provider) and self._is_dialable(provider)]
+        if len(providers) > 0:
+            self.dht.stats['found'] += 1
+            self.dht.stats['hops'].append(result['hops'])
+        return providers
+
+    def provide(self, file_hash):
+        # chunkのproviderとしてDHTに登録する、送信はDHT threadが行う
+        if not V.P2P_ACCEPT:
+            return  # 外から接続できないので登録しても取りに来られない
+        try:
+            self._dht_que.put_nowait(file_hash)
+            self.dht.provided[file_hash] = time.time()
+        except queue.Full:
+            self.dht.provided[file_hash] = 0  # 次の再登録で送る
+
+    def _get_from_providers(self, file_hash):
+        # DHTで見つけたproviderから取得する、未接続なら接続する
+        for host_port in self.find_providers(file_hash):
+            if not self._is_dialable(host_port):
+                continue
+            user = self.p2p.host_port2user(host_port)
+            if user is None:
+                if not self.p2p.create_connection(host=host_port[0], port=host_port[1]):
+                    continue
+                user = self.p2p.host_port2user(host_port)
+                if user is None:
+                    continue
+            try:
+                return self.request_file(file_hash, user)
+            except Exception as e:
+                logging.debug("Failed get file from provider {}, {}".format(host_port, e))
+        return None
+
+    def _is_dialable(self, host_port):
+        # DHTで知ったaddressに接続してよいか、自分自身とglobalでないaddress(local modeを除く)には繋がない
         try:
-            file_hash = file_hash.lower()
-            file_path = os.path.join(V.TMP_PATH, 'file.' + file_hash + '.dat')
-            os.remove(file_path)
+            host, port = host_port
+            if not isinstance(host, str) or not 0 < int(port) < 65536:
+                return False
+            ip = ipaddress.ip_address(host)
+        except (TypeError, ValueError):
+            return False  # 接続で見たaddressはIPなのでhost名は来ない
+        if port == V.P2P_PORT and host in (GLOBAL_IPV4, GLOBAL_IPV6, LOCAL_IP, '127.0.0.1', '::1'):
+            return False
+        if ip.is_unspecified or ip.is_multicast or ip.is_reserved:
+            return False
+        if self.p2p.host == 'localhost':
             return True
+        return not (ip.is_private or ip.is_loopback or ip.is_link_local)
+
+    def _is_known_peer(self, host_port):
+        # peer表にあるか接続中のnode、DHTの応答だけで知らないaddressには繋がない
+        try:
+            host_port = tuple(host_port)
+        except TypeError:
+            return False
+        return host_port in self.peers or self.p2p.host_port2user(host_port) is not None
+
+    def _dht_route(self, cmd, data, sender=None):
+        """
+        keyに近いnodeへ再帰的に転送する、それより近いnodeを知らなければ自分で処理する
+        DHT_FIND => {'providers': [(host, port),..], 'hops': hops}
+        DHT_STORE => {'node': name, 'hops': hops} or None
+        """
+        file_hash = data['hash'].lower()
+        path = list(data.get('path', ()))
+        if cmd == ClientCmd.DHT_FIND:
+            providers = self.dht.get(file_hash)
+            if self._have_chunk(file_hash):
+                providers.append(None)  # 自分, 前のhopが接続先のaddressに置き換える
+            if len(providers) > 0:
+                return {'providers': providers, 'hops': len(path)}
+        hopeful = None
+        if len(path) < V.DHT_MAX_HOPS and data['timeout'] > 1.0:
+            exclude = set(path + [V.SERVER_NAME] + ([sender.name] if sender else []))
+            hopeful = self.dht.next_hop(file_hash, self.p2p.user.copy(), exclude)
+        if hopeful is not None:
+            forward = dict(data, hash=file_hash, path=path + [V.SERVER_NAME], timeout=data['timeout'] - 1.0)
+            try:
+                dummy, result = self.send_command(cmd, forward, user=hopeful, timeout=data['timeout'])
+                self.dht.stats['forward'] += 1
+                if result is not None and cmd == ClientCmd.DHT_FIND:
+                    # Noneは転送先自身で、接続で見たaddressに置き換える
+                    # それ以外は転送先が言うだけなので、peer表で知っているnodeだけ受け入れる
+                    result['providers'] = [hopeful.get_host_port() if provider is None else tuple(provider)
+                                           for provider in result['providers']
+                                           if provider is None or self._is_known_peer(provider)]
+                if result is not None:
+                    return result
+            except Exception as e:
+                logging.debug("Failed DHT forward to {}, {}".format(hopeful.name, e))
+        # 自分がkeyに一番近い
+        if cmd == ClientCmd.DHT_FIND:
+            return {'providers': [], 'hops': len(path)}
+        if data.get('provider') is None:
+            return None  # 自分が登録元, DHT_FINDには自分のstoreで答える
+        self.dht.put(file_hash, data['provider'])
+        temperate = {
+            'type': T_REQUEST,
+            'cmd': ClientCmd.DHT_STORE,
+            'data': {'hash': file_hash, 'provider': data['provider'], 'direct': True},
+            'time': time.time(),
+            'uuid': random.randint(10, 0xffffffff)}
+        replicas = [user for user in self.dht.closest(file_hash, self.p2p.user.copy(), V.DHT_REPLICA)
+                    if user is not sender][:V.DHT_REPLICA - 1]
+        if len(replicas) > 0:
+            self._send_msg(item=temperate, allows=replicas)
+        return {'node': V.SERVER_NAME, 'hops': len(path)}
+
+    def _dht_loop(self):
+        # 取得・共有したchunkをDHTに登録し、期限の半分を過ぎたら登録し直す
+        last_check = 0
+        while not self.f_stop:
+            try:
+                file_hash = self._dht_que.get(timeout=5)
+            except queue.Empty:
+                file_hash = None
+            if time.time() - last_check > 60:
+                last_check = time.time()
+                self.dht.expire()
+                if V.P2P_ACCEPT:
+                    for file_hash_ in self.dht.stale(self.get_chunk_store().keys()):
+                        self.provide(file_hash_)
+            if file_hash is None:
+                continue
+            if len(self.p2p.user) == 0:
+                self.dht.provided[file_hash] = 0  # 接続後に登録し直す
+                continue
+            try:
+                self._dht_route(ClientCmd.DHT_STORE, {'hash': file_hash, 'provider': None, 'path': [], 'timeout': 10})
+            except Exception as e:
+                self.dht.provided[file_hash] = 0
+                logging.debug("Failed DHT store {}, {}".format(file_hash, e))
+        logging.info("Close DHT.")
+
+    @classmethod
+    def remove_file(cls, file_hash):
+        try:
+            return cls.get_chunk_store().remove(file_hash.lower())
         except:
             return False
 
@@ -540,12 +1129,11 @@ class PeerClient:
 
     def remove_file_by_master(self, signer_sk, cert, file_hash):
         file_hash = file_hash.lower()
-        file_path = os.path.join(V.DATA_PATH, 'file.' + file_hash + '.dat')
         uuid = random.randint(10, 99999999)
         signer_ecc = Encryption()
         signer_ecc.sk = signer_sk
         try:
-            os.remove(file_path)
+            self.remove_file(file_hash)
             sign_raw = bjson.dumps((file_hash, uuid), compress=False)
             send_data = {
                 'signer': signer_ecc.pk,
@@ -566,54 +1154,41 @@ class PeerClient:
             (LOCAL_IP, V.P2P_PORT),
             ('127.0.0.1', V.P2P_PORT),
             ('::1', V.P2P_PORT)}
+        sticky_nodes = dict()
         if len(self.peers) == 0:
             logging.info("peer list is zero, need bootnode.")
         else:
+            # 過去の接続実績が良いpeerから順に並列で接続する
             need = max(1, self.p2p.listen // 2)
             logging.info("Connect first nodes, min %d users." % need)
-            peer_host_port = list(self.peers.keys())
-            random.shuffle(peer_host_port)
-            for host_port in peer_host_port:
-                if host_port in ignore_peers:
-                    self.peers.remove(host_port)
-                    continue
-                header = self.peers[host_port]
-                if header['p2p_accept']:
-                    if self.p2p.create_connection(host=host_port[0], port=host_port[1]):
-                        need -= 1
-                    else:
-                        self.peers.remove(host_port)
-                if need <= 0:
-                    break
-                else:
-                    time.sleep(5)
+            ranking = self.peers.ranking(
+                lambda x: x not in ignore_peers and (self.peers.data[x] or {}).get('p2p_accept'))
+            while len(ranking) > 0 and len(self.p2p.user) < need and not self.f_stop:
+                candidates = dict()
+                while len(ranking) > 0 and len(candidates) < need - len(self.p2p.user):
+                    host_port = ranking.pop(0)
+                    if self.p2p.host_port2user(host_port) is None:
+                        candidates[host_port] = False
+                self.dial_peers(candidates, sticky_nodes)
+            logging.info("Connected first nodes {}/{} users.".format(len(self.p2p.user), need))
 
-        # Stabilize
-        user_score = dict()
-        sticky_nodes = dict()
+        # Stabilize, 切断を検知すると待たずに不足分を並列に接続する
         count = 0
         need_connection = 3
         while not self.f_stop:
             count += 1
-            if len(self.p2p.user) <= need_connection:
-                time.sleep(3)
+            target = self.p2p.listen * 2 // 3
+            if len(self.p2p.user) < target:
+                span = 3
             else:
-                time.sleep(1.5 * (1 + random.random()) * len(self.p2p.user))
+                span = min(60, 1.5 * (1 + random.random()) * len(self.p2p.user))
+            self._topology_event.wait(span)
+            self._topology_event.clear()
             if count % 24 == 1 and len(sticky_nodes) > 0:
                 logging.debug("Clean sticky_nodes. [{}=>0]".format(len(sticky_nodes)))
                 sticky_nodes.clear()
             try:
-                if len(self.p2p.user) == 0 and len(self.peers) > 0:
-                    host_port = random.choice(list(self.peers.keys()))
-                    if host_port in ignore_peers:
-                        self.peers.remove(host_port)
-                        continue
-                    if self.p2p.create_connection(host_port[0], host_port[1]):
-                        time.sleep(5)
-                    else:
-                        self.peers.remove(host_port)
-                        continue
-                elif len(self.p2p.user) == 0 and len(self.peers) == 0:
+                if len(self.p2p.user) == 0 and len(self.peers) == 0:
                     time.sleep(10)
                     continue
 
@@ -621,35 +1196,35 @@ class PeerClient:
                 for user in self.p2p.user:
                     self.peers[user.get_host_port()] = user.serialize()
 
-                # update near info
-                sample_user, item = self.send_command(cmd=ClientCmd.GET_NEARS)
-                sample_user.update_neers(item)
+                if len(self.p2p.user) > 0:
+                    # 1つのpeerが応答しなくてもjoin/removeは続ける
+                    try:
+                        # update near info
+                        sample_user = random.choice(self.p2p.user)
+                        sample_user, item = self.send_command(
+                            cmd=ClientCmd.GET_NEARS, data=sample_user.neers_version or {'epoch': None, 'version': 0},
+                            user=sample_user)
+                        self.update_neers(sample_user, item)
+                    except (TimeoutError, ConnectionError, PeerToPeerError, IndexError) as e:
+                        logging.debug("Failed update nears, {}".format(e))
+                    try:
+                        # update rtt
+                        self.send_command(cmd=ClientCmd.PING_PONG, data=time.time())
+                    except (TimeoutError, ConnectionError, PeerToPeerError) as e:
+                        logging.debug("Failed update rtt, {}".format(e))
 
-                # Calculate score (高ければ優先度が高い)
-                search = set(self.peers.keys())
-                for user in self.p2p.user:
-                    for host_port in user.neers.keys():
-                        search.add(host_port)
-                search.difference_update(ignore_peers)
-                average = sum(user_score.values()) // len(user_score) if len(user_score) > 0 else 0
-                for host_port in search:  # 第一・二層を含む
-                    score = user_score[host_port] if host_port in user_score else 20
-                    score -= average
-                    score += sum(1 for user in self.p2p.user if host_port in user.neers)  # 第二層は加点
-                    score -= sum(1 for user in self.p2p.user if host_port == user.get_host_port())  # 第一層は減点
-                    user_score[host_port] = max(-20, min(20, score))
-                if len(user_score) == 0:
+                # Score is updated incrementally (高ければ優先度が高い)
+                if len(self.score_index) == 0:
                     continue
 
                 # Action join or remove or nothing
-                if len(self.p2p.user) > self.p2p.listen * 2 // 3:  # Remove
-                    # スコアの下位半分を取得
-                    sorted_score = sorted(user_score.items(), key=lambda x: x[1])[:len(user_score)//3]
-                    # 既接続のもののみを取得
-                    sorted_score = [(host_port, score) for host_port, score in sorted_score
-                                    if host_port in [user.get_host_port() for user in self.p2p.user]]
+                if len(self.p2p.user) > target:  # Remove
+                    # 既接続のスコア下位1/3を取得
+                    connected = [user.get_host_port() for user in self.p2p.user]
+                    if len(self.long_links.intersection(connected)) <= len(connected) * V.LONG_LINK_RATIO:
+                        connected = [host_port for host_port in connected if host_port not in self.long_links]
+                    sorted_score = self.score_index.bottom(connected, max(1, len(connected) // 3))
                     if len(sorted_score) == 0:
-                        time.sleep(10)
                         continue
                     logging.debug("Remove Score {}".format(sorted_score))
                     host_port, score = random.choice(sorted_score)
@@ -662,47 +1237,18 @@ class PeerClient:
                         logging.debug("Remove connection {} {}".format(host_port, score))
                     else:
                         logging.debug("Failed remove connection. Already disconnected?")
-                        if self.peers.remove(host_port):
-                            del user_score[host_port]
-
-                elif len(self.p2p.user) < self.p2p.listen * 2 // 3:  # Join
-                    # スコア上位半分を取得
-                    sorted_score = sorted(user_score.items(), key=lambda x: x[1], reverse=True)[:len(user_score)//3]
-                    # 既接続を除く
-                    sorted_score = [(host_port, score) for host_port, score in sorted_score
-                                    if host_port not in [user.get_host_port() for user in self.p2p.user]
-                                    and sticky_nodes.get(host_port, 0) < STICKY_LIMIT]
-                    if len(sorted_score) == 0:
-                        time.sleep(10)
-                        continue
-                    logging.debug("Join Score {}".format(sorted_score))
-                    host_port, score = random.choice(sorted_score)
-                    if self.p2p.host_port2user(host_port):
-                        continue  # 既に接続済み
-                    elif sticky_nodes.get(host_port, 0) > STICKY_LIMIT:
-                        continue  # 接続不能回数大杉
-                    elif host_port in ignore_peers:
                         self.peers.remove(host_port)
-                        continue
-                    elif self.p2p.create_connection(host=host_port[0], port=host_port[1]):
-                        logging.debug("New connection {}".format(host_port))
-                    else:
-                        logging.info("Failed connect, remove {}".format(host_port))
-                        sticky_nodes[host_port] = sticky_nodes.get(host_port, 0) + 1
-                        if self.peers.remove(host_port):
-                            del user_score[host_port]
+
+                elif len(self.p2p.user) < target:  # Join
+                    self.join_peers(target - len(self.p2p.user), sticky_nodes, ignore_peers)
 
                 elif len(self.p2p.user) > self.p2p.listen // 2 and random.random() < 0.01:
                     # Mutation
-                    logging.debug("Mutate Score {}".format(user_score))
+                    logging.debug("Mutate Score {}".format(self.score_index.top(SCORE_SAMPLE)))
                     user = random.choice(self.p2p.user)
                     self.p2p.remove_connection(user)
                     logging.debug("Mutate connection, close {}".format(user.name))
 
-                else:
-                    time.sleep(60)  # Do nothing
-                    continue
-
             except TimeoutError as e:
                 logging.info("Stabilize {}".format(e))
             except ConnectionError as e:
@@ -711,6 +1257,122 @@ class PeerClient:
                 logging.debug("Stabilize {}".format(e), exc_info=True)
         logging.error("Get out from loop of stabilize.")
 
+    def join_peers(self, need, sticky_nodes, ignore_peers):
+        # 不足分の接続を並列に試みる
+        def check(x):
+            return x not in self.score_index.connected and x not in ignore_peers \
+                   and sticky_nodes.get(x, 0) < STICKY_LIMIT and x not in candidates
+
+        # 一部は遅延に関係なくランダムに選ぶ(long link)、それ以外はスコア上位を取得
+        candidates = dict()  # {host_port: f_long_link}
+        covered = self.dht.covered_buckets(self.p2p.user)
+        for i in range(need):
+            if random.random() < V.LONG_LINK_RATIO:
+                # 空いているk-bucketのpeerを優先する、DHTの転送がO(log N)hopで済む
+                sample = self.score_index.sample(lambda x: check(x) and self._fill_bucket(x, covered))
+                sorted_score, f_long_link = [sample or self.score_index.sample(check)], True
+            else:
+                sorted_score, f_long_link = self.score_index.top(SCORE_SAMPLE, check), False
+            sorted_score = [score for score in sorted_score if score is not None]
+            if len(sorted_score) == 0:
+                continue
+            host_port, score = random.choice(sorted_score)
+            candidates[host_port] = f_long_link
+        if len(candidates) == 0:
+            return 0
+        logging.debug("Join {} peers {}".format(need, candidates))
+        return self.dial_peers(candidates, sticky_nodes)
+
+    def _fill_bucket(self, host_port, covered):
+        header = self.peers.data.get(host_port) or {}
+        return bool(header.get('name')) and self.dht.bucket(header['name']) not in covered
+
+    def dial_peers(self, candidates, sticky_nodes):
+        # candidates = {host_port: f_long_link}, return success count
+        def connect(host_port, f_long_link):
+            if self.p2p.create_connection(host=host_port[0], port=host_port[1]):
+                self.peers.put_success(host_port)
+                with self._topology_lock:
+                    self.topology['dial_success'] += 1
+                if f_long_link:
+                    self.long_links.add(host_port)
+                result.append(host_port)
+                logging.debug("New connection {} long={}".format(host_port, f_long_link))
+            else:
+                self.peers.put_fail(host_port)
+                with self._topology_lock:
+                    self.topology['dial_fail'] += 1
+                    sticky_nodes[host_port] = sticky_nodes.get(host_port, 0) + 1
+                if self.peers.get_streak(host_port) >= FAIL_LIMIT:
+                    logging.info("Failed connect, remove {}".format(host_port))
+                    self.peers.remove(host_port)
+                else:
+                    logging.debug("Failed connect {}".format(host_port))
+
+        result = list()
+        threads = [Thread(target=connect, args=(host_port, f_long_link), name='Join', daemon=True)
+                   for host_port, f_long_link in candidates.items()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(60)
+        return len(result)
+
+    def _check_degree(self):
+        # 接続数が目標を下回ってから回復するまでの時間を記録する
+        target = self.p2p.listen * 2 // 3
+        with self._topology_lock:
+            if len(self.p2p.user) < target:
+                if self.topology['lost_time'] is None:
+                    self.topology['lost_time'] = time.time()
+                return
+            elif self.topology['lost_time'] is None:
+                return
+            converge = time.time() - self.topology['lost_time']
+            self.topology['lost_time'] = None
+            self.topology['converge_time'].append(converge)
+        logging.debug("Topology converged in {}s".format(round(converge, 2)))
+
+    @staticmethod
+    def cmd2priority(item):
+        # 死活監視などの制御メッセージはFileの転送より先に処理する
+        if item['type'] == T_ACK or item['cmd'] in CONTROL_CMDS:
+            return C.P_HIGH
+        elif item['cmd'] in BULK_CMDS:
+            return C.P_LOW
+        else:
+            return C.P_NORMAL
+
+    def _broadcast_verdict(self, data):
+        # uuidが異なっても同じ内容なら一度だけ検証する
+        digest = sha256(bjson.dumps(data, compress=False)).digest()
+        with self.__broadcast_lock:
+            try:
+                return self.__broadcast_verdict.get(digest)
+            except KeyError:
+                pass
+            event = self.__broadcast_checking.get(digest)
+            if event is None:
+                event = self.__broadcast_checking[digest] = Event()
+                f_checker = True
+            else:
+                f_checker = False
+        if not f_checker:
+            # 他スレッドが検証中なので結果を待つ
+            event.wait(10)
+            try:
+                return self.__broadcast_verdict.get(digest)
+            except KeyError:
+                return bool(self.broadcast_check(data))
+        try:
+            verdict = bool(self.broadcast_check(data))
+            self.__broadcast_verdict.put(digest, verdict)
+            return verdict
+        finally:
+            with self.__broadcast_lock:
+                del self.__broadcast_checking[digest]
+            event.set()
+
     @staticmethod
     def broadcast_check(data):
         return False  # overwrite
@@ -4,6 +4,39 @@ class C:
     # 一度に受け取れる最大データ量(260kBytes)
     MAX_RECEIVE_SIZE = 260000
 
+    # stream multiplexing
+    FRAGMENT_SIZE = 16000  # 1frameの最大data量
+    STREAM_WINDOW = 64000  # streamごとの初期送信window
+    MAX_STREAMS = 256  # 1接続で同時に受信するstream数
+
+    # 1接続の送信待ちframe/stream数、溢れたらP_HIGH以外は空くまで待つ
+    SEND_QUE_SIZE = 1024
+    SEND_QUE_TIMEOUT = 10.0  # sec, 待っても空かなければConnectionError
+
+    # content-defined chunkingのchunk size (min, avg, max)
+    CDC_MIN_SIZE = 16000
+    CDC_AVG_SIZE = 64000
+    CDC_MAX_SIZE = 256000
+
+    # FILE_CHECK_BATCHで一度に問い合わせるhash数
+    CHECK_BATCH_SIZE = 4096
+
+    # DHTへの登録待ちchunk数, 溢れた分は次の再登録で送る
+    DHT_QUEUE_SIZE = 10000
+
+    # smoothing factor of round trip time EWMA
+    RTT_ALPHA = 0.25
+
+    # circuit breaker, 連続してこの回数応答が無いpeerには暫く送らない
+    BREAKER_FAILS = 2
+    BREAKER_TIME = 10.0  # sec, 続けて開くと倍になる(最大16倍)
+    UNKNOWN_RTT = 0.5  # sec, RTTを測っていないpeerの予想値
+
+    # priority (小さいほど優先)
+    P_HIGH = 0  # control frames, ping/ack/nears
+    P_NORMAL = 1
+    P_LOW = 2  # bulk data, file transfer
+
     # type
     T_SERVER = 'type/server'
     T_CLIENT = 'type/client'
@@ -27,6 +60,25 @@ class V:
 
     # setting
     F_FILE_CONTINUE_ASKING = False
+    BROADCAST_CHECK_WORKERS = 1  # threads which run broadcast_check concurrently
+    F_BROADCAST_ORDERED = True  # relay broadcast in received order
+    LATENCY_WEIGHT = 10  # stabilize score reduced by this per 1 sec RTT
+    LONG_LINK_RATIO = 0.25  # ratio of random long links in neighbors
+    PEER_EXCHANGE_LIMIT = 200  # max peers in a GET_PEER_INFO/GET_NEARS response
+    CHUNK_STORE_CAPACITY = None  # bytes of shared chunks kept in TMP_PATH, None is unbounded
+    CHUNK_STORE_BACKEND = 'dir'  # 'dir' one file per chunk, 'pack' append to segment files
+    SHARE_WORKERS = None  # threads for share_raw_file, None is cpu count
+    F_RELAY_CACHE = False  # keep chunks relayed by F_FILE_CONTINUE_ASKING and serve them
+    RELAY_CACHE_CAPACITY = 256000000  # bytes of relay cache, separate from CHUNK_STORE_CAPACITY
+    RELAY_CACHE_ADMIT = 2  # cache a chunk after asked to relay it this many times
+    F_HEDGED_REQUEST = False  # resend idempotent commands to a 2nd peer when the 1st is slow
+    HEDGE_PERCENTILE = 95  # resend after this percentile of recent response time
+    HEDGE_MIN_DELAY = 0.05  # sec
+    F_DHT = False  # find chunk providers by DHT when no neighbor has it
+    DHT_REPLICA = 3  # nodes which keep a provider record
+    DHT_RECORD_TTL = 3600  # sec, providers announce again after half of it
+    DHT_RECORD_LIMIT = 100000  # max provider records kept by a node
+    DHT_MAX_HOPS = 20
 
 
 class Debug:
@@ -12,9 +12,9 @@ import selectors
 from threading import Thread, Lock, Event
 from nem_ed25519.base import Encryption
 from .tool.traffic import Traffic
-from .tool.utils import AESCipher, QueueSystem
+from .tool.utils import AESCipher, QueueSystem, is_compressible
 from .config import C, V, Debug, PeerToPeerError
-from .user import User
+from .user import User, F_FIN, F_WINDOW, F_RAW, F_CHUNK
 
 # constant
 SERVER_SIDE = 'Server'
@@ -44,6 +44,8 @@ class Core:
         self.traffic = Traffic()
         self._ping = Event()
         self._ping.set()
+        self.on_connect = list()  # [function(user),..]
+        self.on_disconnect = list()  # [function(user),..]
         self.udp_ipv4_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_ipv6_sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
 
@@ -60,9 +62,12 @@ class Core:
         try:
             self._ping.wait(10)
             self._ping.clear()
-            self.send_msg_body(msg_body=b'Ping', user=user, f_udp=f_udp, f_pro_force=True)
+            ping_time = time.time()
+            self.send_msg_body(msg_body=b'Ping', user=user, f_udp=f_udp, f_pro_force=True, priority=C.P_HIGH)
             r = self._ping.wait(5)
             self._ping.set()
+            if r:
+                user.put_rtt(time.time() - ping_time)
             return r
         except Exception as e:
             logging.debug("Failed ping by {} udp={}".format(e, f_udp))
@@ -93,7 +98,7 @@ class Core:
                 msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
                 if msg_body == b'Ping':
                     logging.debug("Get udp accept from {}".format(user))
-                    self.send_msg_body(msg_body=b'Pong', user=user)
+                    self.send_msg_body(msg_body=b'Pong', user=user, priority=C.P_HIGH)
                 else:
                     logging.debug("Get udp packet from {}".format(user))
                     self.core_que.broadcast((user, msg_body))
@@ -185,6 +190,9 @@ class Core:
             'p2p_accept': V.P2P_ACCEPT,
             'p2p_udp_accept': V.P2P_UDP_ACCEPT,
             'p2p_port': V.P2P_PORT,
+            'p2p_mux': True,
+            'p2p_chunk': True,
+            'p2p_dht': True,
             'start_time': self.start_time}
 
     def create_connection(self, host, port):
@@ -212,9 +220,11 @@ class Core:
             send = json.dumps(self.get_server_header()).encode()
             sock.sendall(send)
             self.traffic.put_traffic_up(send)
+            handshake_time = time.time()
             # 公開鍵を受取る
             receive = sock.recv(self.buffsize)
             self.traffic.put_traffic_down(receive)
+            handshake_time = time.time() - handshake_time
             public_key = json.loads(receive.decode())['public-key']
             # 公開鍵を送る
             send = json.dumps({'public-key': self.ecc.pk}).encode()
@@ -229,12 +239,14 @@ class Core:
             # ユーザーを作成する
             with self.lock:
                 new_user = User(self.number, sock, host_port, aeskey, C.T_CLIENT)
+                new_user.on_send_error = self.remove_connection
                 new_user.deserialize(header)
                 # headerのチェック
                 if new_user.network_ver != V.NETWORK_VER:
                     raise PeerToPeerError('Don\'t same network version [{}!={}]'
                                           .format(new_user.network_ver, V.NETWORK_VER))
                 self.number += 1
+            new_user.put_rtt(handshake_time)
             # Acceptシグナルを送る
             encrypted = AESCipher.encrypt(new_user.aeskey, b'accept')
             sock.sendall(encrypted)
@@ -283,14 +295,17 @@ class Core:
         user.close()
         if user in self.user.copy():
             with self.lock:
+                if user not in self.user:
+                    return False
                 self.user.remove(user)
             logging.debug("remove connection to {} by \"{}\"".format(user.name, reason))
+            self._call_hooks(self.on_disconnect, user)
             return True
         else:
             logging.debug("failed remove connection by \"{}\", not found {}".format(reason, user.name))
             return False
 
-    def send_msg_body(self, msg_body, user=None, status=200, f_udp=False, f_pro_force=False):
+    def send_msg_body(self, msg_body, user=None, status=200, f_udp=False, f_pro_force=False, priority=C.P_NORMAL):
         # StatusCode: https://ja.wikipedia.org/wiki/HTTPステータスコード
         assert type(msg_body) == bytes, 'msg_body is bytes'
         assert 200 <= status < 600, 'Not found status code {}'.format(status)
@@ -304,23 +319,41 @@ class Core:
             self.send_msg_body(msg_body=bjson.dumps(error), user=user, status=500)
             raise ConnectionRefusedError(error)
         elif user is None:
-            user = random.choice(self.user)
+            user = self.choose_user()
 
         # send message
         if f_udp and f_pro_force:
             self._udp_body(msg_body, user)
         elif f_udp and user.p2p_udp_accept and len(msg_body) < 1400:
             self._udp_body(msg_body, user)
+        elif user.p2p_mux:
+            msg_body = zlib.compress(msg_body)
+            user.send_stream(msg_body, priority)
+            self.traffic.put_traffic_up(msg_body)
         else:
             msg_body = zlib.compress(msg_body)
             msg_body = AESCipher.encrypt(key=user.aeskey, raw=msg_body)
             msg_len = len(msg_body).to_bytes(4, 'big')
             send_data = msg_len + msg_body
-            user.send(send_data)
+            user.send_by_priority(send_data, priority)
             self.traffic.put_traffic_up(send_data)
         # logging.debug("Send {}Kb to '{}'".format(len(msg_len+msg_body) / 1000, user.name))
         return user
 
+    def send_chunk_body(self, msg_body, chunk, user, priority=C.P_NORMAL):
+        # msg_body(header)とchunkを連結せずに1つのstreamで送る、chunkはmmapのsliceでも良い
+        assert user.p2p_chunk, 'user {} do not accept chunk frame'.format(user.name)
+        assert len(chunk) <= C.MAX_RECEIVE_SIZE, 'Max chunk size is {}kb'.format(C.MAX_RECEIVE_SIZE // 1000)
+        flags = F_CHUNK
+        if is_compressible(chunk):
+            chunk = zlib.compress(chunk)
+        else:
+            flags |= F_RAW  # 圧縮できないchunkはそのまま
+        user.send_stream([len(msg_body).to_bytes(4, 'big'), msg_body, chunk], priority, flags)
+        self.traffic.put_traffic_up(msg_body)
+        self.traffic.put_traffic_up(chunk)
+        return user
+
     def _udp_body(self, msg_body, user):
         name_len = len(V.SERVER_NAME.encode()).to_bytes(1, 'big')
         msg_body = AESCipher.encrypt(key=user.aeskey, raw=msg_body)
@@ -344,6 +377,7 @@ class Core:
             with self.lock:
                 new_user = User(self.number, sock, host_port,
                                 aeskey=AESCipher.create_key(), sock_type=C.T_SERVER)
+                new_user.on_send_error = self.remove_connection
                 self.number += 1
             new_user.deserialize(header)
             if new_user.name == V.SERVER_NAME:
@@ -352,9 +386,11 @@ class Core:
             send = json.dumps({'public-key': self.ecc.pk}).encode()
             sock.sendall(send)
             self.traffic.put_traffic_up(send)
+            handshake_time = time.time()
             # 公開鍵を取得する
             receive = new_user.sock.recv(self.buffsize)
             self.traffic.put_traffic_down(receive)
+            new_user.put_rtt(time.time() - handshake_time)
             if len(receive) == 0:
                 raise ConnectionAbortedError('received msg is zero.')
             public_key = json.loads(receive.decode())['public-key']
@@ -395,83 +431,73 @@ class Core:
         except: pass
 
     def _receive_msg(self, user):
-        # Accept connection
-        with self.lock:
-            for check_user in self.user:
-                if check_user.name != user.name:
-                    continue
-                if self.ping(check_user):
-                    error = "Remove new connection {}, continue connect {}".format(user, check_user)
-                    self.remove_connection(user, error)
-                    logging.info(error)
-                else:
-                    error = "Same origin, Replace new connection {} => {}".format(check_user, user)
-                    self.remove_connection(check_user, error)
-                    logging.info(error)
-            self.user.append(user)
+        # Accept connection, 同名の確認と追加は同じlockの中で行い、ping等はlockの外で行う
+        while True:
+            with self.lock:
+                check_user = None
+                for user_ in self.user:
+                    if user_.name == user.name:
+                        check_user = user_
+                        break
+                if check_user is None:
+                    self.user.append(user)
+                    break
+            if self.ping(check_user) and self._initiator(check_user) <= self._initiator(user):
+                # 同時に接続し合った場合も両方のノードで同じ接続を残す
+                error = "Remove new connection {}, continue connect {}".format(user, check_user)
+                user.close()
+                logging.info(error)
+                return
+            else:
+                error = "Same origin, Replace new connection {} => {}".format(check_user, user)
+                self.remove_connection(check_user, error)
+                logging.info(error)
         logging.info("Accept connection \"{}\"".format(user.name))
+        self._call_hooks(self.on_connect, user)
 
         # pooling
-        msg_prefix = b''
+        buffer = bytearray()
+        streams = dict()  # {stream_id: [body, received]}
         msg_len = 0
         msg_body = b''
         error = None
         try:
             while not self.f_stop:
-                if len(msg_prefix) == 0:
-                    user.sock.settimeout(3600)
-                    first_msg = user.sock.recv(self.buffsize)
-                    user.sock.settimeout(10)
-                else:
-                    first_msg, msg_prefix = msg_prefix, b''
-
                 # Start receive message
-                msg_len = int.from_bytes(first_msg[:4], 'big')
-                msg_body = first_msg[4:]
-
-                # Notice long message
-                if Debug.F_LONG_MSG_INFO and msg_len != len(msg_body):
-                    logging.debug("Receive long msg, len=%d, body=%d" % (msg_len, len(msg_body)))
-
+                while len(buffer) < 4:
+                    self._receive_sock(user, buffer, 3600 if len(buffer) == 0 else 10)
+                msg_len = int.from_bytes(buffer[:4], 'big')
                 if msg_len == 0:
                     raise ConnectionAbortedError("1:Socket error, fall in loop.")
-                elif len(msg_body) == 0:
-                    raise ConnectionAbortedError("2:Socket error, fall in loop.")
-                elif len(msg_body) >= msg_len:
-                    msg_body, msg_prefix = msg_body[:msg_len], msg_body[msg_len:]
-                    self.traffic.put_traffic_down(msg_body)
-                    msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
-                    msg_body = zlib.decompress(msg_body)
-                    if msg_body == b'Ping':
-                        logging.debug("receive ping from {}".format(user.name))
-                        self.send_msg_body(b'Pong', user)
-                        continue
-                    elif msg_body == b'Pong':
-                        logging.debug("receive Pong from {}".format(user.name))
-                        self._ping.set()
-                        continue
-                    else:
-                        self.core_que.broadcast((user, msg_body))
-                    continue
+                elif msg_len > C.MAX_RECEIVE_SIZE + 5000:
+                    raise ConnectionAbortedError("Too many data! (MAX {}Kb)"
+                                                 .format(C.MAX_RECEIVE_SIZE // 1000))
+
+                # Notice long message
+                if Debug.F_LONG_MSG_INFO and msg_len + 4 > len(buffer):
+                    logging.debug("Receive long msg, len=%d, body=%d" % (msg_len, len(buffer) - 4))
 
                 # continue receiving message
-                while True:
-                    new_body = user.sock.recv(self.buffsize)
-                    msg_body += new_body
-                    if len(new_body) == 0:
-                        raise ConnectionAbortedError("3:Socket error, fall in loop.")
-                    elif len(msg_body) >= msg_len:
-                        msg_body, msg_prefix = msg_body[:msg_len], msg_body[msg_len:]
-                        self.traffic.put_traffic_down(msg_body)
-                        msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
-                        msg_body = zlib.decompress(msg_body)
-                        self.core_que.broadcast((user, msg_body))
-                        break
-                    elif len(msg_body) > C.MAX_RECEIVE_SIZE + 5000:
-                        raise ConnectionAbortedError("Too many data! (MAX {}Kb)"
-                                                     .format(C.MAX_RECEIVE_SIZE // 1000))
-                    else:
-                        continue
+                while len(buffer) < msg_len + 4:
+                    self._receive_sock(user, buffer, 10)
+                msg_body = bytes(buffer[4:msg_len + 4])
+                del buffer[:msg_len + 4]
+                self.traffic.put_traffic_down(msg_body)
+                msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
+                if user.p2p_mux:
+                    msg_body = self._receive_fragment(user, msg_body, streams)
+                    if msg_body is None:
+                        continue  # stream is not finished
+                else:
+                    msg_body = zlib.decompress(msg_body)
+                if msg_body == b'Ping':
+                    logging.debug("receive ping from {}".format(user.name))
+                    self.send_msg_body(b'Pong', user, priority=C.P_HIGH)
+                elif msg_body == b'Pong':
+                    logging.debug("receive Pong from {}".format(user.name))
+                    self._ping.set()
+                else:
+                    self.core_que.broadcast((user, msg_body))
 
         except socket.timeout:
             error = "socket timeout {}".format(user.name)
@@ -490,6 +516,51 @@ class Core:
         if not self.remove_connection(user, error):
             logging.debug("Failed remove user {}".format(user.name))
 
+    @staticmethod
+    def _receive_sock(user, buffer, timeout):
+        user.sock.settimeout(timeout)
+        new_body = user.sock.recv(C.FRAGMENT_SIZE * 4)
+        if len(new_body) == 0:
+            raise ConnectionAbortedError("2:Socket error, fall in loop.")
+        buffer.extend(new_body)
+
+    @staticmethod
+    def _receive_fragment(user, msg_body, streams):
+        # return joined body when the stream is finished, else None
+        stream_id = int.from_bytes(msg_body[:4], 'big')
+        flags = msg_body[4]
+        fragment = msg_body[5:]
+        if flags & F_WINDOW:
+            user.update_window(stream_id, int.from_bytes(fragment, 'big'))
+            return None
+        if stream_id not in streams:
+            if len(streams) >= C.MAX_STREAMS:
+                raise ConnectionAbortedError("Too many streams! (MAX {})".format(C.MAX_STREAMS))
+            streams[stream_id] = [bytearray(), 0]
+        body = streams[stream_id]
+        body[0].extend(fragment)
+        body[1] += len(fragment)
+        if len(body[0]) > C.MAX_RECEIVE_SIZE + 5000:
+            raise ConnectionAbortedError("Too many data! (MAX {}Kb)"
+                                         .format(C.MAX_RECEIVE_SIZE // 1000))
+        if flags & F_FIN:
+            del streams[stream_id]
+            if flags & F_CHUNK:
+                # return (header, chunk)
+                view = memoryview(body[0])
+                header_len = int.from_bytes(view[:4], 'big')
+                header = bytes(view[4:4 + header_len])
+                chunk = view[4 + header_len:]
+                return header, bytes(chunk) if flags & F_RAW else zlib.decompress(chunk)
+            if flags & F_RAW:
+                return bytes(body[0])
+            return zlib.decompress(body[0])
+        if body[1] >= C.STREAM_WINDOW // 2:
+            # 受信した分だけ送信windowを広げる
+            user.send_window(stream_id, body[1])
+            body[1] = 0
+        return None
+
     def is_reachable(self, new_user):
         # Check connect to the user TCP/UDP port
         if new_user not in self.user:
@@ -516,6 +587,33 @@ class Core:
                           .format(new_user, new_user.p2p_udp_accept, f_udp))
             new_user.p2p_udp_accept = f_udp
 
+    @staticmethod
+    def _initiator(user):
+        # name of the node which created the connection
+        return V.SERVER_NAME if user.sock_type == C.T_CLIENT else user.name
+
+    @staticmethod
+    def _call_hooks(hooks, user):
+        for function in hooks:
+            try:
+                function(user)
+            except Exception as e:
+                logging.debug("Hook error, {} {}".format(user.name, e), exc_info=Debug.P_EXCEPTION)
+
+    def choose_user(self, users=None):
+        """
+        power of two choices, randomに2人選び予想応答時間(RTT, 応答待ち数, error rate)が小さい方
+        circuit breakerが開いているpeerは全員開いている時以外は選ばない
+        """
+        users = self.user.copy() if users is None else list(users)
+        if len(users) == 0:
+            raise ConnectionError('client connection is zero.')
+        candidates = [user for user in users if user.is_available()] or users
+        if len(candidates) == 1:
+            return candidates[0]
+        a, b = random.sample(candidates, 2)
+        return a if a.cost() <= b.cost() else b
+
     def name2user(self, name):
         for user in self.user:
             if user.name == name:
@@ -12,7 +12,7 @@ import logging
 import copy
 from nem_ed25519.base import Encryption
 from nem_ed25519.signature import verify
-from .utils import StackDict, QueueSystem, AESCipher
+from .utils import LRUCache, QueueSystem, AESCipher
 from ..client import ClientCmd
 from ..config import V, Debug
 
@@ -120,7 +120,7 @@ class Channel(Thread):
         # 変数
         self.members = MemberList()  # {pk: rank,..}
         self.aes_key = collections.deque(maxlen=5)
-        self.__result = StackDict()
+        self.__result = LRUCache()
         self.message_que = QueueSystem()  # (f_private, signer, item)
 
     def cmd_send_ecc(self, cmd, data, pk, dummy_pk=None, uuid=None, wait=-1):
@@ -0,0 +1,721 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock, get_ident
+import collections
+import logging
+import struct
+import mmap
+import os
+from hashlib import sha256
+
+
+def hash2bytes(file_hash):
+    # 64文字のhexならsha256 digest、外から来た不正なhashはNone
+    if not isinstance(file_hash, str) or len(file_hash) != 64:
+        return None
+    try:
+        return bytes.fromhex(file_hash)
+    except ValueError:
+        return None
+
+
+class ChunkStore:
+    """
+    sha256で名前を付けたchunkの保存先
+    root/ab/cd/abcd...ef.dat  hashの先頭で分割したdirに置く
+    root/ab/cd/abcd...ef.pin  pinされたchunkは容量を超えても消さない
+    存在するhashはメモリ上の索引で引くのでFILE_CHECKはO(1)
+    """
+    def __init__(self, root, capacity=None, depth=2, legacy_dir=None):
+        self.root = root
+        self.capacity = capacity  # bytes, None is unbounded
+        self.depth = depth  # 分割するdirの階層数
+        self.index = dict()  # {hash: size}
+        self.lru = collections.OrderedDict()  # {hash: size} pinされていないchunk、古い順
+        self.pinned = set()
+        self.size = 0
+        self.lock = Lock()
+        self.hit = self.miss = self.evicted = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.load()
+        if legacy_dir:
+            self.migrate(legacy_dir)
+
+    def __repr__(self):
+        return "<ChunkStore {} {}chunks {}kb>".format(self.root, len(self.index), self.size // 1000)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, file_hash):
+        return file_hash in self.index
+
+    def keys(self):
+        return list(self.index)
+
+    def path(self, file_hash, f_pin=None):
+        if f_pin is None:
+            f_pin = file_hash in self.pinned
+        dirs = [file_hash[i*2:i*2+2] for i in range(self.depth)]
+        return os.path.join(self.root, *dirs, file_hash + ('.pin' if f_pin else '.dat'))
+
+    def load(self):
+        files = list()
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for name in file_names:
+                file_hash, ext = os.path.splitext(name)
+                path = os.path.join(dir_path, name)
+                if ext == '.tmp':
+                    os.remove(path)  # 書き込み途中で止まった
+                elif ext in ('.dat', '.pin') and len(file_hash) == 64:
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, file_hash, stat.st_size, ext == '.pin'))
+        files.sort()
+        for mtime, file_hash, size, f_pin in files:
+            self.index[file_hash] = size
+            self.size += size
+            if f_pin:
+                self.pinned.add(file_hash)
+            else:
+                self.lru[file_hash] = size
+        logging.debug("Load chunk store {}".format(self))
+
+    def migrate(self, legacy_dir):
+        # 旧形式 legacy_dir/file.<hash>.dat を取り込む
+        count = 0
+        for name in os.listdir(legacy_dir):
+            path = os.path.join(legacy_dir, name)
+            if not (name.startswith('file.') and name.endswith('.dat') and os.path.isfile(path)):
+                continue
+            file_hash = name[5:-4].lower()
+            if hash2bytes(file_hash) is None:
+                continue  # chunkでないfileはそのまま残す
+            with open(path, mode='br') as fp:
+                self.put(file_hash, fp.read())
+            os.remove(path)
+            count += 1
+        if count:
+            logging.info("Migrate {} chunks to {}".format(count, self.root))
+
+    def put(self, file_hash, raw, f_pin=False):
+        if file_hash in self.index:
+            with self.lock:
+                if file_hash in self.lru:
+                    self.lru.move_to_end(file_hash)
+            if f_pin:
+                self.pin(file_hash)
+            return
+        path = self.path(file_hash, f_pin=f_pin)
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        tmp_path = path + '.{}.tmp'.format(get_ident())
+        with open(tmp_path, mode='bw') as fp:
+            fp.write(raw)
+        with self.lock:
+            if file_hash in self.index:
+                os.remove(tmp_path)  # written by another thread
+                return
+            os.replace(tmp_path, path)
+            self.index[file_hash] = len(raw)
+            self.size += len(raw)
+            if f_pin:
+                self.pinned.add(file_hash)
+            else:
+                self.lru[file_hash] = len(raw)
+        self.__evict()
+
+    def get(self, file_hash):
+        with self.lock:
+            if file_hash not in self.index:
+                self.miss += 1
+                return None
+            self.hit += 1
+            if file_hash in self.lru:
+                self.lru.move_to_end(file_hash)
+            fp = self.__open(file_hash)
+        if fp is None:
+            # 外から消された
+            self.__drop(file_hash)
+            return None
+        with fp:
+            return fp.read()
+
+    def view(self, file_hash):
+        # return memoryview of mmap, コピーせずにchunkを送る
+        with self.lock:
+            if file_hash not in self.index:
+                self.miss += 1
+                return None
+            self.hit += 1
+            if file_hash in self.lru:
+                self.lru.move_to_end(file_hash)
+            if self.index[file_hash] == 0:
+                return memoryview(b'')
+            fp = self.__open(file_hash)
+        if fp is None:
+            self.__drop(file_hash)
+            return None
+        with fp:
+            return memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def remove(self, file_hash):
+        with self.lock:
+            if file_hash not in self.index:
+                return False
+            path = self.path(file_hash)
+        self.__drop(file_hash)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def pin(self, file_hash):
+        with self.lock:
+            if file_hash not in self.index or file_hash in self.pinned:
+                return False
+            os.replace(self.path(file_hash, f_pin=False), self.path(file_hash, f_pin=True))
+            self.pinned.add(file_hash)
+            del self.lru[file_hash]
+            return True
+
+    def unpin(self, file_hash):
+        with self.lock:
+            if file_hash not in self.pinned:
+                return False
+            os.replace(self.path(file_hash, f_pin=True), self.path(file_hash, f_pin=False))
+            self.pinned.discard(file_hash)
+            self.lru[file_hash] = self.index[file_hash]
+        self.__evict()
+        return True
+
+    def files(self):
+        # return [(path, size, time), ...]
+        files = list()
+        for file_hash in self.keys():
+            path = self.path(file_hash)
+            try:
+                files.append((path, os.path.getsize(path), os.path.getmtime(path)))
+            except FileNotFoundError:
+                continue  # evicted
+        return files
+
+    def getinfo(self):
+        return {
+            'chunks': len(self.index),
+            'pinned': len(self.pinned),
+            'size': self.size,
+            'capacity': self.capacity,
+            'hit': self.hit,
+            'miss': self.miss,
+            'evicted': self.evicted}
+
+    def __open(self, file_hash):
+        # with self.lock, pin/unpinが.dat/.pinを付け替えている間に開かないようにlockの中で開く
+        try:
+            return open(self.path(file_hash), mode='br')
+        except FileNotFoundError:
+            return None
+
+    def __drop(self, file_hash):
+        with self.lock:
+            size = self.index.pop(file_hash, None)
+            if size is not None:
+                self.size -= size
+            self.lru.pop(file_hash, None)
+            self.pinned.discard(file_hash)
+
+    def __evict(self):
+        # pinされていない古いchunkから消す
+        if self.capacity is None or self.size <= self.capacity:
+            return
+        remove_paths = list()
+        with self.lock:
+            while self.size > self.capacity and len(self.lru) > 0:
+                file_hash, size = self.lru.popitem(last=False)
+                remove_paths.append(self.path(file_hash, f_pin=False))
+                del self.index[file_hash]
+                self.size -= size
+                self.evicted += 1
+        for path in remove_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if remove_paths:
+            logging.debug("Evict {} chunks from {}".format(len(remove_paths), self))
+
+
+class PackStore:
+    """
+    chunkを大きなsegment fileに追記して保存する、inodeはsegment数だけ
+    root/pack.<n>.seg  chunkを追記するだけのfile
+    root/pack.idx      hashでsortした (hash, segment, offset, length, flag) の表、mmapして二分探索
+    root/pack.log      前回idxを作ってからの追加・削除・pin、溜まったらidxに統合する
+    容量を超えたらpinされていないchunkを古い順に消し、空きの多いsegmentは詰め直す
+    """
+    record = struct.Struct('>32sIQIB')  # hash, segment, offset, length, flag
+    journal = struct.Struct('>B32sIQIB')  # op, hash, segment, offset, length, flag
+    header = struct.Struct('>4sQ')  # magic, count
+    fanout = struct.Struct('>256I')  # 先頭1byte以下のrecord数
+    OP_PUT, OP_DEL = 1, 2
+    F_PIN = 1
+
+    def __init__(self, root, capacity=None, segment_size=256 * 1000 * 1000, merge_limit=10000, legacy_dir=None):
+        self.root = root
+        self.capacity = capacity  # bytes, None is unbounded
+        self.segment_size = segment_size  # 超えたら次のsegmentへ
+        self.merge_limit = merge_limit  # logの数がこれを超えたらidxへ統合
+        self.lock = Lock()
+        self.idx_fp = self.idx_mm = None
+        self.idx_count = 0
+        self.idx_fanout = (0,) * 256
+        self.recent = dict()  # {hash: (segment, offset, length, flag)} idxより新しい
+        self.deleted = set()  # idxにあるが消されたhash
+        self.log_fp = None
+        self.log_count = 0
+        self.fds = dict()  # {segment: fd}
+        self.maps = dict()  # {segment: mmap} view用
+        self.seg_size = dict()  # {segment: file size}
+        self.seg_live = dict()  # {segment: live bytes}
+        self.dirty = set()  # 前回idxを作ってから書き込んだsegment, idxを作る前にfsyncする
+        self.active = 0  # 追記中のsegment
+        self.count = self.size = 0
+        self.hit = self.miss = self.evicted = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.load()
+        if legacy_dir:
+            self.migrate(legacy_dir)
+
+    def __repr__(self):
+        return "<PackStore {} {}chunks {}kb {}segments>".format(
+            self.root, self.count, self.size // 1000, len(self.seg_size))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, file_hash):
+        h = hash2bytes(file_hash)
+        if h is None:
+            return False
+        with self.lock:
+            return self.__lookup(h) is not None
+
+    def keys(self):
+        with self.lock:
+            return [item[2].hex() for item in self.__locations()]
+
+    def segment_path(self, segment):
+        return os.path.join(self.root, 'pack.{}.seg'.format(segment))
+
+    def load(self):
+        for name in os.listdir(self.root):
+            if name.startswith('pack.') and name.endswith('.seg'):
+                segment = int(name[5:-4])
+                self.seg_size[segment] = os.path.getsize(os.path.join(self.root, name))
+                self.seg_live[segment] = 0
+                self.active = max(self.active, segment)
+        self.__open_idx()
+        for i in range(self.idx_count):
+            h, segment, offset, length, flag = self.__idx_record(self.idx_mm, i)
+            self.__count(segment, length)
+        # logを再生、途中で切れたrecordは捨てる
+        log_path = os.path.join(self.root, 'pack.log')
+        if os.path.exists(log_path):
+            with open(log_path, mode='br') as fp:
+                raw = fp.read()
+            size = len(raw) - len(raw) % self.journal.size
+            for op, h, segment, offset, length, flag in self.journal.iter_unpack(raw[:size]):
+                self.__apply(op, h, (segment, offset, length, flag))
+            if size < len(raw):
+                logging.warning("Truncate broken pack log {}=>{}bytes".format(len(raw), size))
+                with open(log_path, mode='ba') as fp:
+                    fp.truncate(size)
+            self.log_count = size // self.journal.size
+        self.log_fp = open(log_path, mode='ba')
+        logging.debug("Load chunk store {}".format(self))
+
+    def migrate(self, legacy_dir):
+        # 旧形式 legacy_dir/file.<hash>.dat を取り込む
+        count = 0
+        for name in os.listdir(legacy_dir):
+            path = os.path.join(legacy_dir, name)
+            if not (name.startswith('file.') and name.endswith('.dat') and os.path.isfile(path)):
+                continue
+            file_hash = name[5:-4].lower()
+            if hash2bytes(file_hash) is None:
+                continue  # chunkでないfileはそのまま残す
+            with open(path, mode='br') as fp:
+                self.put(file_hash, fp.read())
+            os.remove(path)
+            count += 1
+        if count:
+            logging.info("Migrate {} chunks to {}".format(count, self.root))
+
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+            self.maps.clear()
+            if self.log_fp:
+                self.log_fp.close()
+                self.log_fp = None
+            self.__close_idx()
+
+    def put(self, file_hash, raw, f_pin=False):
+        h = hash2bytes(file_hash)
+        if h is None:
+            raise ValueError('invalid chunk hash {!r}'.format(file_hash))
+        with self.lock:
+            location = self.__lookup(h)
+            if location is None:
+                if self.seg_size.get(self.active, 0) >= self.segment_size:
+                    self.active += 1
+                segment = self.active
+                offset = self.seg_size.get(segment, 0)
+                os.pwrite(self.__fd(segment), raw, offset)
+                self.seg_size[segment] = offset + len(raw)
+                self.dirty.add(segment)
+                self.__write(self.OP_PUT, h, (segment, offset, len(raw), self.F_PIN if f_pin else 0))
+            elif f_pin and not location[3] & self.F_PIN:
+                self.__write(self.OP_PUT, h, location[:3] + (location[3] | self.F_PIN,))
+        self.__evict()
+
+    def get(self, file_hash):
+        h = hash2bytes(file_hash)
+        with self.lock:
+            # compactでsegmentが閉じられないようlock中に1回のpreadで読む
+            location = None if h is None else self.__lookup(h)
+            if location is None:
+                self.miss += 1
+                return None
+            self.hit += 1
+            segment, offset, length, flag = location
+            return os.pread(self.__fd(segment), length, offset)
+
+    def view(self, file_hash):
+        # return memoryview of segment mmap, コピーせずにchunkを送る
+        h = hash2bytes(file_hash)
+        with self.lock:
+            location = None if h is None else self.__lookup(h)
+            if location is None:
+                self.miss += 1
+                return None
+            self.hit += 1
+            segment, offset, length, flag = location
+            if length == 0:
+                return memoryview(b'')
+            mm = self.maps.get(segment)
+            if mm is None or len(mm) < offset + length:
+                # 追記されて伸びたsegmentは貼り直す、古いmmapは使用中のviewが無くなれば閉じる
+                mm = self.maps[segment] = mmap.mmap(self.__fd(segment), 0, access=mmap.ACCESS_READ)
+            return memoryview(mm)[offset:offset + length]
+
+    def remove(self, file_hash):
+        h = hash2bytes(file_hash)
+        if h is None:
+            return False
+        with self.lock:
+            location = self.__lookup(h)
+            if location is None:
+                return False
+            self.__write(self.OP_DEL, h, location)
+        self.__compact()
+        return True
+
+    def pin(self, file_hash):
+        h = hash2bytes(file_hash)
+        return h is not None and self.__set_flag(h, True)
+
+    def unpin(self, file_hash):
+        h = hash2bytes(file_hash)
+        f_changed = h is not None and self.__set_flag(h, False)
+        self.__evict()
+        return f_changed
+
+    def files(self):
+        # return [(path, size, time), ...] segment fileの中にあるchunk
+        with self.lock:
+            mtime = {segment: os.path.getmtime(self.segment_path(segment)) for segment in self.seg_size}
+            return [(self.segment_path(segment), length, mtime[segment])
+                    for segment, offset, h, length, flag in self.__locations()]
+
+    def getinfo(self):
+        return {
+            'chunks': self.count,
+            'size': self.size,
+            'capacity': self.capacity,
+            'segments': len(self.seg_size),
+            'disk': sum(self.seg_size.values()),
+            'hit': self.hit,
+            'miss': self.miss,
+            'evicted': self.evicted}
+
+    def __set_flag(self, h, f_pin):
+        with self.lock:
+            location = self.__lookup(h)
+            if location is None or bool(location[3] & self.F_PIN) == f_pin:
+                return False
+            flag = location[3] | self.F_PIN if f_pin else location[3] & ~self.F_PIN
+            self.__write(self.OP_PUT, h, location[:3] + (flag,))
+            return True
+
+    def __fd(self, segment):
+        fd = self.fds.get(segment)
+        if fd is None:
+            fd = self.fds[segment] = os.open(self.segment_path(segment), os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            self.seg_size.setdefault(segment, 0)
+            self.seg_live.setdefault(segment, 0)
+        return fd
+
+    def __count(self, segment, length, sign=1):
+        self.seg_live[segment] = self.seg_live.get(segment, 0) + sign * length
+        self.count += sign
+        self.size += sign * length
+
+    def __idx_record(self, mm, i):
+        start = self.header.size + self.fanout.size + i * self.record.size
+        return self.record.unpack_from(mm, start)
+
+    def __idx_search(self, h):
+        # fanoutで範囲を絞ってから二分探索
+        mm = self.idx_mm
+        lo = self.idx_fanout[h[0] - 1] if h[0] > 0 else 0
+        hi = self.idx_fanout[h[0]]
+        base = self.header.size + self.fanout.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + mid * self.record.size
+            key = mm[start:start + 32]
+            if key < h:
+                lo = mid + 1
+            elif key > h:
+                hi = mid
+            else:
+                return self.record.unpack_from(mm, start)[1:]
+        return None
+
+    def __lookup(self, h):
+        location = self.recent.get(h)
+        if location is not None:
+            return location
+        if h in self.deleted or self.idx_count == 0:
+            return None
+        return self.__idx_search(h)
+
+    def __apply(self, op, h, location):
+        old = self.__lookup(h)
+        if old is not None:
+            self.__count(old[0], old[2], -1)
+        if op == self.OP_PUT:
+            self.recent[h] = location
+            self.__count(location[0], location[2])
+        elif op == self.OP_DEL:
+            self.recent.pop(h, None)
+            if self.idx_count > 0 and self.__idx_search(h) is not None:
+                self.deleted.add(h)
+
+    def __write(self, op, h, location):
+        # with self.lock, segmentに書いてからlogに書く
+        self.__apply(op, h, location)
+        self.log_fp.write(self.journal.pack(op, h, *location))
+        self.log_fp.flush()
+        self.log_count += 1
+        if self.log_count > self.merge_limit:
+            self.__merge()
+
+    def __open_idx(self):
+        path = os.path.join(self.root, 'pack.idx')
+        if not os.path.exists(path):
+            self.idx_count = 0
+            self.idx_fanout = (0,) * 256
+            return
+        self.idx_fp = open(path, mode='br')
+        self.idx_mm = mmap.mmap(self.idx_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.idx_count = self.header.unpack_from(self.idx_mm, 0)
+        assert magic == b'PIDX', 'broken pack index {}'.format(path)
+        self.idx_fanout = self.fanout.unpack_from(self.idx_mm, self.header.size)
+
+    def __close_idx(self):
+        if self.idx_mm is not None:
+            self.idx_mm.close()
+            self.idx_fp.close()
+        self.idx_fp = self.idx_mm = None
+        self.idx_count = 0
+
+    def __merge(self):
+        # with self.lock, idxとlogを統合して新しいidxを書き、logを空にする
+        # idxが指すchunkが消えないよう、先にsegmentとlogをdiskに書き出す
+        for segment in self.dirty:
+            if segment in self.fds:
+                os.fsync(self.fds[segment])
+        self.dirty.clear()
+        self.log_fp.flush()
+        os.fsync(self.log_fp.fileno())
+        records = [(h,) + location for h, location in self.recent.items()]
+        for i in range(self.idx_count):
+            item = self.__idx_record(self.idx_mm, i)
+            if item[0] not in self.recent and item[0] not in self.deleted:
+                records.append(item)
+        records.sort()
+        fanout = [0] * 256
+        for item in records:
+            fanout[item[0][0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        path = os.path.join(self.root, 'pack.idx')
+        with open(path + '.tmp', mode='bw') as fp:
+            fp.write(self.header.pack(b'PIDX', len(records)))
+            fp.write(self.fanout.pack(*fanout))
+            for item in records:
+                fp.write(self.record.pack(*item))
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.__close_idx()
+        os.replace(path + '.tmp', path)
+        self.__open_idx()
+        self.recent.clear()
+        self.deleted.clear()
+        self.log_fp.close()
+        self.log_fp = open(os.path.join(self.root, 'pack.log'), mode='bw')
+        self.log_count = 0
+        logging.debug("Merge pack index {}".format(self))
+
+    def __locations(self, segments=None):
+        # with self.lock, [(segment, offset, hash, length, flag),..] segmentsを指定すればその中だけ
+        items = [(location[0], location[1], h, location[2], location[3]) for h, location in self.recent.items()
+                 if segments is None or location[0] in segments]
+        for i in range(self.idx_count):
+            h, segment, offset, length, flag = self.__idx_record(self.idx_mm, i)
+            if (segments is None or segment in segments) and h not in self.recent and h not in self.deleted:
+                items.append((segment, offset, h, length, flag))
+        return items
+
+    def __evict(self):
+        # pinされていないchunkを古いsegmentから消す、少し余裕を持たせる
+        # 全chunkをsortせず、消す分だけの古いsegmentを選んでその中のchunkだけ並べる
+        if self.capacity is None or self.size <= self.capacity:
+            return
+        with self.lock:
+            goal = self.capacity * 9 // 10
+            segments = sorted(self.seg_size)
+            while self.size > goal and len(segments) > 0:
+                targets, free = set(), 0
+                while len(segments) > 0 and self.size - free > goal:
+                    segment = segments.pop(0)
+                    targets.add(segment)
+                    free += self.seg_live.get(segment, 0)
+                for segment, offset, h, length, flag in sorted(self.__locations(targets)):
+                    if self.size <= goal:
+                        break
+                    if flag & self.F_PIN:
+                        continue
+                    self.__write(self.OP_DEL, h, (segment, offset, length, flag))
+                    self.evicted += 1
+        self.__compact()
+
+    def __compact(self, ratio=0.5):
+        # 生きているchunkが少ないsegmentを詰め直して消す
+        with self.lock:
+            targets = [segment for segment in self.seg_size if segment != self.active
+                       and self.seg_live.get(segment, 0) < self.seg_size[segment] * ratio]
+            if len(targets) == 0:
+                return
+            moved = 0
+            for segment, offset, h, length, flag in sorted(self.__locations(set(targets))):
+                raw = os.pread(self.__fd(segment), length, offset)
+                if self.seg_size.get(self.active, 0) >= self.segment_size:
+                    self.active += 1
+                new_offset = self.seg_size.get(self.active, 0)
+                os.pwrite(self.__fd(self.active), raw, new_offset)
+                self.seg_size[self.active] = new_offset + length
+                self.dirty.add(self.active)
+                self.__write(self.OP_PUT, h, (self.active, new_offset, length, flag))
+                moved += 1
+            # 消すsegmentを指すlogが残らないようにidxへ統合してから消す
+            self.__merge()
+            for segment in targets:
+                fd = self.fds.pop(segment, None)
+                if fd is not None:
+                    os.close(fd)
+                self.maps.pop(segment, None)
+                os.remove(self.segment_path(segment))
+                del self.seg_size[segment]
+                self.seg_live.pop(segment, None)
+                self.dirty.discard(segment)
+        logging.debug("Compact {} segments, move {} chunks {}".format(len(targets), moved, self))
+
+
+class RelayCache:
+    """
+    FILE_GETを中継したchunkを別のstoreに一定量だけ置き、次からは自分で返す
+    何度も中継を頼まれたchunkだけ入れる(popularity admission)、一度きりのchunkでcacheを流さない
+    countは一定回数数える毎に半分にして古い人気を忘れる
+    """
+    def __init__(self, store, admit=2, sample=10000):
+        self.store = store  # capacityを指定したChunkStore/PackStore
+        self.admit = admit  # この回数以上頼まれたchunkを入れる
+        self.sample = sample
+        self.counts = dict()  # {hash: 頼まれた回数}
+        self.seen = 0
+        self.lock = Lock()
+        self.admitted = self.rejected = self.corrupted = 0
+
+    def __repr__(self):
+        return "<RelayCache {} admit={}>".format(self.store, self.admit)
+
+    @staticmethod
+    def _normalize(file_hash):
+        # storeのkeyは小文字hex, 大文字で来ても同じchunkとして扱う
+        if hash2bytes(file_hash) is None:
+            return None
+        return file_hash.lower()
+
+    def __contains__(self, file_hash):
+        file_hash = self._normalize(file_hash)
+        return file_hash is not None and file_hash in self.store
+
+    def touch(self, file_hash):
+        # 中継を頼まれた時に呼ぶ, return 回数
+        file_hash = self._normalize(file_hash)
+        if file_hash is None:
+            return 0
+        with self.lock:
+            self.seen += 1
+            if self.seen >= self.sample:
+                self.seen = 0
+                self.counts = {k: v // 2 for k, v in self.counts.items() if v > 1}
+            count = self.counts[file_hash] = self.counts.get(file_hash, 0) + 1
+            return count
+
+    def offer(self, file_hash, raw):
+        # 中継したchunk, return False ならhashが合わないので渡さない
+        file_hash = self._normalize(file_hash)
+        if file_hash is None or sha256(raw).hexdigest() != file_hash:
+            self.corrupted += 1
+            return False
+        if self.counts.get(file_hash, 0) >= self.admit:
+            self.store.put(file_hash, bytes(raw))
+            self.admitted += 1
+        else:
+            self.rejected += 1
+        return True
+
+    def view(self, file_hash):
+        file_hash = self._normalize(file_hash)
+        return None if file_hash is None else self.store.view(file_hash)
+
+    def get(self, file_hash):
+        file_hash = self._normalize(file_hash)
+        return None if file_hash is None else self.store.get(file_hash)
+
+    def getinfo(self):
+        r = self.store.getinfo()
+        r.update({'admitted': self.admitted, 'rejected': self.rejected,
+                  'corrupted': self.corrupted, 'tracked': len(self.counts)})
+        return r
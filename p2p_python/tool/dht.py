@@ -0,0 +1,146 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from hashlib import sha256
+from threading import Lock
+import collections
+import time
+
+
+def name2node_id(name):
+    # node名(V.SERVER_NAME)からKademliaのnode idを作る, 接続先の隣接ノードのidも名前から分かる
+    return int.from_bytes(sha256(name.encode()).digest(), 'big')
+
+
+def hash2key(file_hash):
+    return int(file_hash, 16)
+
+
+class DHT:
+    """
+    Kademlia風のDHT, chunk hashをkeyにしてprovider(host, port)を保存する
+    接続中のpeerにしか送れないので、keyにXOR距離が近い接続先(とその隣接ノード)へ再帰的に転送し、
+    それより近いnodeを知らないnodeがrecordを持つ。long linkで空のk-bucketを埋めるとO(log N)hopで届く
+    ここはrecordと経路選択だけで、送受信はPeerClientが行う
+    """
+    max_providers = 20  # 1keyあたりのprovider数
+
+    def __init__(self, name, ttl=3600, limit=100000):
+        self.name = name
+        self.node_id = name2node_id(name)
+        self.ttl = ttl
+        self.limit = limit
+        self.lock = Lock()
+        self.records = collections.OrderedDict()  # {hex hash: {(host, port): expire}} 古い順
+        self.provided = dict()  # {hex hash: 最後にannounceした時刻}
+        self.ids = dict()  # {name: node id} cache
+        self.stats = {'find': 0, 'found': 0, 'store': 0, 'forward': 0,
+                      'hops': collections.deque(maxlen=100)}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return "<DHT {} records={}>".format(self.name, len(self.records))
+
+    def node_id_of(self, name):
+        node_id = self.ids.get(name)
+        if node_id is None:
+            if len(self.ids) > self.limit:
+                self.ids.clear()
+            node_id = self.ids[name] = name2node_id(name)
+        return node_id
+
+    def bucket(self, name):
+        # XOR距離の最上位bit, 遠いほど大きい
+        return (self.node_id ^ self.node_id_of(name)).bit_length() - 1
+
+    def covered_buckets(self, users):
+        return set(self.bucket(user.name) for user in users if user.name)
+
+    def next_hop(self, file_hash, users, exclude=()):
+        """
+        自分よりkeyに近い接続先を返す, 無ければNone(自分がrecordを持つ)
+        接続先の隣接ノードまで見て、近いnodeに繋がっているuserを選ぶ
+        """
+        key = hash2key(file_hash)
+        best = None
+        best_distance = (self.node_id ^ key, 0)
+        for user in users:
+            if not user.p2p_dht or user.name in exclude:
+                continue
+            direct = self.node_id_of(user.name) ^ key
+            distance = direct
+            for header in list(user.neers.values()):
+                name = header.get('name') if isinstance(header, dict) else None
+                if name and name not in exclude and name != self.name:
+                    distance = min(distance, self.node_id_of(name) ^ key)
+            if (distance, direct) < best_distance:
+                best, best_distance = user, (distance, direct)
+        return best
+
+    def closest(self, file_hash, users, k):
+        # keyに近い接続先k件, recordの複製先
+        key = hash2key(file_hash)
+        users = [user for user in users if user.p2p_dht]
+        return sorted(users, key=lambda user: self.node_id_of(user.name) ^ key)[:k]
+
+    def is_replica(self, file_hash, users, k, name=None):
+        # name(Noneなら自分)が自分と接続先の中でkeyに近いk件に入るか, 複製を受け入れる時に確かめる
+        key = hash2key(file_hash)
+        distance = (self.node_id if name is None else self.node_id_of(name)) ^ key
+        closer = 0 if name is None or self.node_id ^ key > distance else 1
+        for user in users:
+            if user.p2p_dht and user.name != name and self.node_id_of(user.name) ^ key < distance:
+                closer += 1
+        return closer < k
+
+    def put(self, file_hash, provider):
+        with self.lock:
+            providers = self.records.pop(file_hash, dict())
+            providers[tuple(provider)] = time.time() + self.ttl
+            if len(providers) > self.max_providers:
+                oldest = min(providers, key=providers.get)
+                del providers[oldest]
+            self.records[file_hash] = providers
+            while len(self.records) > self.limit:
+                self.records.popitem(last=False)
+            self.stats['store'] += 1
+
+    def get(self, file_hash):
+        # return [(host, port),..] 期限切れは返さない
+        now = time.time()
+        with self.lock:
+            providers = self.records.get(file_hash, dict())
+            return [provider for provider, expire in providers.items() if expire > now]
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for file_hash in list(self.records):
+                providers = self.records[file_hash]
+                for provider in [p for p, expire in providers.items() if expire <= now]:
+                    del providers[provider]
+                if len(providers) == 0:
+                    del self.records[file_hash]
+
+    def stale(self, keys):
+        # return announceし直すchunk, 新しいchunkと期限の半分を過ぎたchunk
+        now = time.time()
+        keys = set(keys)
+        for file_hash in list(self.provided):
+            if file_hash not in keys:
+                del self.provided[file_hash]
+        return [file_hash for file_hash in keys if self.provided.get(file_hash, 0) < now - self.ttl / 2]
+
+    def getinfo(self):
+        hops = list(self.stats['hops'])
+        return {
+            'node_id': '{:064x}'.format(self.node_id),
+            'records': len(self.records),
+            'provided': len(self.provided),
+            'find': self.stats['find'],
+            'found': self.stats['found'],
+            'store': self.stats['store'],
+            'forward': self.stats['forward'],
+            'hops': sum(hops) / len(hops) if hops else None}
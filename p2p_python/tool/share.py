@@ -8,10 +8,17 @@ from hashlib import sha256
 import bjson
 import logging
 import random
+import heapq
+import bisect
+import collections
+import itertools
+import io
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from binascii import hexlify
 from ..config import C, V, PeerToPeerError
 from ..client import FileReceiveError, ClientCmd
-from .utils import AESCipher
+from .utils import AESCipher, MerkleTree, bitfield2index, index2bitfield, cdc_candidates, cdc_boundaries
 
 
 class FileShare:
@@ -21,47 +28,167 @@ class FileShare:
         self.path = path
         self.f_contain = list()
         self.content = dict()
+        self.share_key = None  # sha256 of joined element, bitfieldを交換する時のkey
+        self.merkle = None  # MerkleTree of element
+        self.throughput = None  # MB/s of last share_raw_file
+        self.share_path = None  # .share file, 進捗は隣の.stateに保存する
 
     @staticmethod
     def create_ley():
         return AESCipher.create_key()
 
-    def share_raw_file(self, pwd=None):
+    def share_raw_file(self, pwd=None, workers=None, cdc=False):
+        """
+        chunkのhashと暗号化はthread poolで並列に行い、読込と保存は順番通り行う
+        workers => thread数, Noneの時はV.SHARE_WORKERS or cpu数, 1以下なら直列
+        cdc => 内容で切る位置を決める, 一部が変わったfileでも残りのchunkは同じhashになる
+        """
         if not os.path.exists(self.path):
             raise FileExistsError('Not found file.')
         if not os.path.isfile(self.path):
             raise Exception('It\'s a directory.')
-        h_list = list()
-        sha_hash = sha256()
+        start = time.time()
+        size = os.path.getsize(self.path)
+        # 暗号化するとIVとpaddingで最大32bytes増えるのでその分小さく切る
+        chunk_size = C.MAX_RECEIVE_SIZE - 32 if pwd else C.MAX_RECEIVE_SIZE
+        workers = workers or V.SHARE_WORKERS or os.cpu_count() or 1
         with open(self.path, mode='br') as f:
-            while True:
-                raw = f.read(C.MAX_RECEIVE_SIZE)
-                if not raw:
-                    break
-                sha_hash.update(raw)
-                if pwd:
-                    raw = AESCipher.encrypt(key=pwd, raw=raw)
-                h_list.append(sha256(raw).digest())
-                self.pc.share_file(data=raw)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+            try:
+                if cdc:
+                    chunk_size = min(C.CDC_MAX_SIZE, chunk_size)
+                    boundaries = cdc_boundaries(cdc_candidates(mm, C.CDC_AVG_SIZE), size,
+                                                C.CDC_MIN_SIZE, C.CDC_AVG_SIZE, chunk_size)
+                else:
+                    boundaries = list(range(chunk_size, size, chunk_size)) + [size] if size > 0 else []
+                offsets = [0] + boundaries[:-1]
+                tasks = [(self.path, offset, end - offset, pwd) for offset, end in zip(offsets, boundaries)]
+                h_list = list()
+                sha_hash = sha256()
+                reused = 0
+                for (_, offset, length, _), (digest, enc) in zip(tasks, self._encode_chunks(tasks, workers)):
+                    raw = mm[offset:offset + length]
+                    sha_hash.update(raw)
+                    h_list.append(digest)
+                    file_hash = hexlify(digest).decode()
+                    if self.pc.get_file(file_hash, only_check=True):
+                        reused += 1  # 他のfileと同じchunk
+                    self.pc.share_file(data=enc or raw, file_hash=file_hash)
+            finally:
+                if size > 0:
+                    mm.close()
         self.content = {
             'name': self.name,
             'path': self.path,
             'size': os.path.getsize(self.path) / 1000,
+            'bytes': size,
             'element': h_list,
+            'chunk_size': chunk_size,
             'hash': sha_hash.hexdigest(),
+            'root': None,
             'signer': None,
             'sign': None,
             'date': time.strftime('%Y-%m-%d %H:%M:%S'),
             'time': int(time.time())}
+        if cdc:
+            self.content['sizes'] = [length for _, _, length, _ in tasks]
+        self.merkle = MerkleTree(h_list)
+        self.content['root'] = hexlify(self.merkle.root).decode()
+        self.f_contain = [True] * len(h_list)
+        self.share_key = self.pc.register_share(h_list)
+        passed = max(time.time() - start, 1e-6)
+        self.throughput = round(size / passed / 1000000, 2)
+        logging.info("Shared {} {}kb {}chunks ({} reused) in {}s, {}MB/s"
+                     .format(self.name, size // 1000, len(h_list), reused, round(passed, 2), self.throughput))
+
+    @staticmethod
+    def _encode_chunks(tasks, workers):
+        # 順番通りに(digest, enc)を返す, 先行するのはworkers*4chunkまで
+        # sha256とAESは計算中GILを離すのでthreadで並列になる、forkしないので起動後の(threadのある)clientでも使える
+        if workers <= 1 or len(tasks) <= 1:
+            yield from map(_encode_chunk, tasks)
+            return
+        window = workers * 4
+        with ThreadPoolExecutor(max_workers=min(workers, len(tasks)), thread_name_prefix='Share') as executor:
+            futures = collections.deque()
+            for task in tasks:
+                futures.append(executor.submit(_encode_chunk, task))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
 
-    def load_share_file(self):
+    def load_share_file(self, root=None):
+        """
+        root => hex Merkle root, 指定すればrootだけを信頼してshare fileを検証する
+        """
         if len(self.content) != 0:
             raise Exception('Already loaded share file.')
         with open(self.path, mode='br') as f:
-            self.content = bjson.load(fp=f)
+            content = bjson.load(fp=f)
+        merkle = MerkleTree(content['element'])
+        if content.get('root') is not None and content['root'] != hexlify(merkle.root).decode():
+            raise ValueError('Merkle root of share file don\'t match.')
+        if root is not None and root.lower() != hexlify(merkle.root).decode():
+            raise ValueError('Share file is not the one of root {}.'.format(root))
+        self.content = content
+        self.content['root'] = hexlify(merkle.root).decode()
+        self.merkle = merkle
+        self.share_path = self.path
         self.f_contain = [False] * len(self.content['element'])
         self.name = self.content['name']
         self.path = self.content['path']
+        self.load_state()
+        self.share_key = self.pc.register_share(self.content['element'])
+
+    def state_path(self):
+        return None if self.share_path is None else self.share_path + '.state'
+
+    def load_state(self):
+        """
+        保存した進捗を読み込みchunk storeと突き合わせる、return 持っているchunk数
+        消されたchunkは取得し直し、他のfileで取得済みのchunkは持っているとする
+        """
+        path = self.state_path()
+        claimed = set()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, mode='br') as f:
+                    state = bjson.load(fp=f)
+                if state['root'] == self.content['root']:
+                    claimed.update(bitfield2index(state['bitfield'], len(self.f_contain)))
+                else:
+                    logging.warning("Ignore state of other share file {}".format(path))
+            except Exception as e:
+                logging.warning("Failed load state {}, {}".format(path, e))
+        store = self.pc.get_chunk_store()
+        lost = found = 0
+        for index, h in enumerate(self.content['element']):
+            f_have = hexlify(h).decode() in store
+            if index in claimed and not f_have:
+                lost += 1
+            elif f_have and index not in claimed:
+                found += 1
+            self.f_contain[index] = f_have
+        done = sum(self.f_contain)
+        if claimed or found:
+            logging.info("Resume {} {}/{} chunks, {} lost and {} found in store"
+                         .format(self.name, done, len(self.f_contain), lost, found))
+        return done
+
+    def save_state(self):
+        # f_containを.share fileの隣に保存する、途中で落ちても壊れないよう置き換える
+        path = self.state_path()
+        if path is None or 'root' not in self.content:
+            return False
+        state = {
+            'root': self.content['root'],
+            'bitfield': index2bitfield([i for i, f in enumerate(self.f_contain) if f], len(self.f_contain)),
+            'time': int(time.time())}
+        with open(path + '.tmp', mode='bw') as f:
+            bjson.dump(state, fp=f)
+        os.replace(path + '.tmp', path)
+        return True
 
     def recode_raw_file(self, recode_dir, pwd=None, overwrite=False):
         if not os.path.exists(recode_dir):
@@ -75,8 +202,9 @@ class FileShare:
             raise FileNotFoundError('Isn\'t all file downloaded, ({}% complete)'.format(complete))
         sha_hash = sha256()
         with open(recode_path, mode='ba') as f:
-            for h in self.content['element']:
+            for i, h in enumerate(self.content['element']):
                 raw = self.pc.get_file(file_hash=hexlify(h).decode())
+                self.verify_chunk(i, raw)
                 if pwd:
                     raw = AESCipher.decrypt(key=pwd, enc=raw)
                 sha_hash.update(raw)
@@ -91,23 +219,72 @@ class FileShare:
             raise FileExistsError('You try to over write file.')
         with open(path, mode='bw') as f:
             bjson.dump(self.content, fp=f, compress=compress)
+        self.share_path = path
 
     def get_all_binary(self, pwd=None):
-        result = b''
+        result = list()
         check = self.check()
         sha_hash = sha256()
         if len(check) > 0:
             complete = str(round(len(check) / len(self.f_contain) * 100, 2))
             raise FileNotFoundError('Isn\'t all file downloaded, ({}% complete)'.format(complete))
-        for h in self.content['element']:
+        for i, h in enumerate(self.content['element']):
             raw = self.pc.get_file(file_hash=hexlify(h).decode())
+            self.verify_chunk(i, raw)
             if pwd:
                 raw = AESCipher.decrypt(key=pwd, enc=raw)
             sha_hash.update(raw)
-            result += raw
+            result.append(raw)
         if sha_hash.hexdigest() != self.content['hash']:
             raise Exception('SHA256 hash don\'t match.')
-        return result
+        return b''.join(result)
+
+    def open(self, pwd=None, read_ahead=4, cache=8):
+        """
+        return seekable file-like object, 読んだ所のchunkから取得するので全て揃うのを待たない
+        read_ahead => 先読みするchunk数, cache => メモリに置くchunk数
+        """
+        return ShareReader(self, pwd=pwd, read_ahead=read_ahead, cache=cache)
+
+    def chunk_offsets(self):
+        # return [start offset of chunk,..] + [file size]
+        if self.content.get('sizes'):
+            # content-defined chunkingの時はchunk毎に大きさが違う
+            return list(itertools.accumulate([0] + self.content['sizes']))
+        chunk_size = self.content.get('chunk_size', C.MAX_RECEIVE_SIZE)
+        size = self.content.get('bytes')
+        if size is None:
+            size = int(round(self.content['size'] * 1000))  # 旧形式はkBのfloatしか無い
+        offsets = list(range(0, size, chunk_size))[:len(self.content['element'])]
+        return offsets + [size]
+
+    def read_chunk(self, index, pwd=None):
+        # 無ければ取得して検証し、復号したchunkを返す
+        raw = self.pc.get_file(file_hash=hexlify(self.content['element'][index]).decode())
+        self.verify_chunk(index, raw)
+        self.f_contain[index] = True
+        if pwd:
+            raw = AESCipher.decrypt(key=pwd, enc=raw)
+        return raw
+
+    def proof(self, index):
+        # index番目のchunkがrootに含まれる証明, MerkleTree.verifyで検証する
+        return self.merkle.proof(index)
+
+    def verify_chunk(self, index, raw, proof=None):
+        """
+        chunkを1つずつrootに対して検証する、届いた順に検証できるので最後まで待たない
+        proof => element一覧を持っていない時はproofとrootで検証する
+        """
+        leaf = sha256(raw).digest()
+        if proof is not None:
+            f_valid = MerkleTree.verify(leaf, index, len(self.content['element']),
+                                        proof, bytes.fromhex(self.content['root']))
+        else:
+            f_valid = self.content['element'][index] == leaf  # elementはrootで検証済み
+        if not f_valid:
+            raise ValueError('Chunk {} don\'t match Merkle root.'.format(index))
+        return True
 
     def check(self):
         # return uncompleted element index
@@ -116,77 +293,494 @@ class FileShare:
     def remove_sharefile_related(self):
         for hash_bin in self.content['element']:
             self.pc.remove_file(hexlify(hash_bin).decode())
+        path = self.state_path()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
     def get_tmp_files(self):
         # return [(path, size, time), ...]
-        files = list()
-        for f in os.listdir(self.pc.tmp_dir):
-            path = os.path.join(self.pc.tmp_dir, f)
-            if not f.startswith('file.'):
-                continue
-            if not os.path.isfile(path):
-                continue
-            size = os.path.getsize(path)
-            date = os.path.getmtime(path)
-            files.append((path, size, date))
-        return files
+        return self.pc.get_chunk_store().files()
 
-    def download(self, num=3, wait=True):
+    def download(self, num=3, wait=True, callback=None):
+        """
+        全ての接続先へ並列にchunkを要求する
+        num => 1peerあたり同時に要求するchunk数
+        callback => function(event) 進捗の通知、eventはSwarmDownload.progress参照
+        wait=Falseの時はSwarmDownloadを返す
+        """
         if 'element' not in self.content:
             return False
-        request = [i for i in range(len(self.content['element'])) if not self.f_contain[i]]
-        lock = threading.Lock()
-        threads = list()
-        f_finish = [None] * num
-        for n in range(num):
-            t = threading.Thread(
-                target=self.__download, args=(request, f_finish, lock), name='FileShare', daemon=True)
-            t.start()
-            threads.append(t)
-            time.sleep(1)
+        swarm = SwarmDownload(self, depth=num, callback=callback)
+        swarm.start()
         if wait:
-            for t in threads:
-                t.join()
+            swarm.join()
+            return swarm.is_complete()
         else:
-            return request, f_finish
+            return swarm
 
-    def __download(self, request, f_finish, lock):
-        allow_fail = max(5, len(request) // 1000)
-        while True:
-            # check retry counts
-            if allow_fail < 0:
-                f_finish.pop()
-                return
-            # get index, hash to try
-            with lock:
-                try:
-                    i = random.choice(request)
-                    request.remove(i)
-                except IndexError:
-                    f_finish.pop()
-                    return
-            hex_hash = hexlify(self.content['element'][i]).decode()
-            logging.debug("Try %d=0x%s" % (i, hex_hash))
-            retry = 5
-            while True:
-                try:
-                    raw = self.pc.get_file(file_hash=hex_hash, only_check=False)
-                    if raw:
-                        with lock:
-                            self.f_contain[i] = True
-                        logging.debug("Success %d=0x%s" % (i, hex_hash))
-                        break
-                    else:
-                        raise FileReceiveError('Failed get file, retry')
-                except (FileReceiveError, TimeoutError) as e:
-                    retry -= 1
-                    if retry > 0:
-                        time.sleep(5)
+
+def _encode_chunk(task):
+    """
+    thread poolで動く, 各threadがファイルを直接読む
+    return (sha256 digest of stored chunk, encrypted chunk or None)
+    """
+    path, offset, length, pwd = task
+    with open(path, mode='br') as f:
+        f.seek(offset)
+        raw = f.read(length)
+    if pwd:
+        raw = AESCipher.encrypt(key=pwd, raw=raw)
+        return sha256(raw).digest(), raw
+    return sha256(raw).digest(), None
+
+
+class SwarmDownload:
+    """
+    FileShareのchunkを接続中の全peerからpipelineで取得する
+    接続したpeerとbitfieldを交換して各peerが持っているchunkを知り、
+    希少なchunk(持っていないと分かったpeerが多い)から順に要求し、
+    peer毎の速度を記録して遅いpeerに割り当てたchunkは他のpeerにも要求する
+    """
+    fail_limit = 5  # 連続してこの回数失敗したpeerには要求しない
+    save_interval = 10.0  # sec, 進捗を.stateに保存する間隔
+    slow_factor = 3  # 予想時間のこの倍かかっているchunkは他のpeerにも要求する
+    min_slow = 2.0  # sec
+    idle_limit = 60.0  # sec, 接続中のpeerが誰も頼めるchunkを持たないまま過ぎたら諦める
+
+    def __init__(self, fs, depth=3, callback=None):
+        self.fs = fs
+        self.pc = fs.pc
+        self.depth = depth
+        self.callback = callback
+        self.hashes = [hexlify(h).decode() for h in fs.content['element']]
+        self.share_key = fs.share_key or self.pc.register_share(fs.content['element'])
+        self.total = len(self.hashes)
+        self.lock = threading.Lock()
+        self.done = sum(1 for f in fs.f_contain if f)
+        self.pending = set(i for i in range(self.total) if not fs.f_contain[i])
+        self.assigned = dict()  # {index: {user: start time}}
+        self.rarity = [0] * self.total  # 持っていないと分かったpeer数 - 持っていると分かったpeer数
+        self.heap = list()  # [(-rarity, random, index),..] 古いrarityのentryは捨てる
+        self.have = dict()  # {user: set(index)}
+        self.missing = dict()  # {user: set(index)}
+        self.peers = dict()  # {user: {'rate', 'bytes', 'success', 'fail', 'streak', 'inflight', 'workers'}}
+        self.size = 0
+        self.start_time = None
+        self.finish_time = None
+        self.f_stop = False
+        self.event = threading.Event()  # 全て取得したらsupervisorを起こす
+        self.thread = None
+        for index in self.pending:
+            heapq.heappush(self.heap, (0, random.random(), index))
+
+    def __repr__(self):
+        return "<SwarmDownload {} {}/{} {}peers>".format(self.fs.name, self.done, self.total, len(self.peers))
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._supervisor, name='Swarm', daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def stop(self):
+        self.f_stop = True
+
+    def is_complete(self):
+        return self.done >= self.total
+
+    def set_have(self, user, indexes, f_have=True):
+        # peerが持っている(いない)chunkを登録する、希少度を更新
+        with self.lock:
+            self._set_have(user, indexes, f_have)
+
+    def _set_have(self, user, indexes, f_have):
+        # with self.lock
+        have = self.have.setdefault(user, set())
+        missing = self.missing.setdefault(user, set())
+        add, other = (have, missing) if f_have else (missing, have)
+        for index in indexes:
+            if index in add:
+                continue
+            add.add(index)
+            delta = -1 if f_have else 1
+            if index in other:
+                other.discard(index)
+                delta *= 2
+            self.rarity[index] += delta
+            if index in self.pending:
+                heapq.heappush(self.heap, (-self.rarity[index], random.random(), index))
+
+    def _on_have(self, share_key, user, indexes):
+        if share_key == self.share_key:
+            self.set_have(user, indexes)
+
+    def _start_peer(self, user):
+        # bitfieldを交換してからworkerを動かす、旧版のnodeならFILE_GETで試しながら知る
+        try:
+            bitfield = self.pc.exchange_bitfield(self.share_key, user)
+            f_old = False
+        except Exception as e:
+            logging.debug("Failed exchange bitfield with {}, {}".format(user.name, e))
+            bitfield = None
+            f_old = True
+        if f_old:
+            indexes = have = None
+        elif bitfield is not None:
+            indexes = range(self.total)
+            have = set(bitfield2index(bitfield, self.total))
+        else:
+            # share fileを知らなくてもchunkを持っているかもしれないのでまとめて問い合わせる
+            with self.lock:
+                indexes = sorted(self.pending)
+            result = self.pc.check_files([self.hashes[index] for index in indexes], users=[user]).get(user)
+            have = None if result is None else set(index for index, f in zip(indexes, result) if f)
+        if have is not None:
+            self.set_have(user, have)
+            self.set_have(user, [index for index in indexes if index not in have], f_have=False)
+        for n in range(self.depth):
+            threading.Thread(target=self._worker, args=(user,), name='Swarm', daemon=True).start()
+
+    def getinfo(self):
+        with self.lock:
+            elapsed = (self.finish_time or time.time()) - self.start_time if self.start_time else 0
+            return {
+                'name': self.fs.name,
+                'done': self.done,
+                'total': self.total,
+                'pending': len(self.pending),
+                'assigned': len(self.assigned),
+                'size': self.size,
+                'speed': self.size / elapsed if elapsed > 0 else 0,  # bytes/sec
+                'peers': {user.name: dict(stat) for user, stat in self.peers.items()}}
+
+    def progress(self, event, index=None, user=None, **kwargs):
+        # event => 'start', 'chunk', 'fail', 'slow', 'complete', 'abort'
+        if self.callback is None:
+            return
+        r = {
+            'event': event,
+            'index': index,
+            'peer': user.name if user else None,
+            'done': self.done,
+            'total': self.total,
+            'size': self.size,
+            'time': time.time()}
+        r.update(kwargs)
+        try:
+            self.callback(r)
+        except Exception as e:
+            logging.debug("Swarm callback error {}".format(e), exc_info=True)
+
+    def _supervisor(self):
+        # 新しく接続したpeerにもworkerを割り当てる
+        self.progress('start')
+        self.pc.on_have.append(self._on_have)
+        no_peer_time = None
+        last_save = time.time()
+        while not self.f_stop and not self.is_complete():
+            for user in list(self.pc.p2p.user):
+                with self.lock:
+                    if user in self.peers:
                         continue
+                    self.peers[user] = {'rate': None, 'bytes': 0, 'success': 0, 'fail': 0,
+                                        'streak': 0, 'inflight': 0, 'workers': self.depth}
+                threading.Thread(target=self._start_peer, args=(user,), name='Swarm', daemon=True).start()
+            # 頼めるchunkが無くて止まったworkerは、FILE_HAVE等で頼めるchunkが出来たら動かし直す
+            connected = set(self.pc.p2p.user)
+            respawn = list()
+            with self.lock:
+                for user, stat in self.peers.items():
+                    if stat['workers'] == 0 and user in connected and self._pickable(user):
+                        stat['workers'] = self.depth
+                        respawn.append(user)
+                working = sum(stat['workers'] for stat in self.peers.values())
+                usable = any(user in connected and stat['streak'] < self.fail_limit
+                             for user, stat in self.peers.items())
+            for user in respawn:
+                for n in range(self.depth):
+                    threading.Thread(target=self._worker, args=(user,), name='Swarm', daemon=True).start()
+            if working > 0:
+                no_peer_time = None
+            elif no_peer_time is None:
+                no_peer_time = time.time()
+            elif time.time() - no_peer_time > (self.idle_limit if usable else 10):
+                break  # 取得できるpeerがいない
+            self.event.wait(1)
+            with self.lock:
+                self._refresh()
+            if time.time() - last_save > self.save_interval:
+                self._save_state()
+                last_save = time.time()
+        self.f_stop = True
+        self.finish_time = time.time()
+        self._save_state()
+        self.pc.on_have.remove(self._on_have)
+        if self.is_complete():
+            self.progress('complete')
+        else:
+            self.progress('abort')
+        logging.debug("Finish swarm {} {}".format(self, self.getinfo()))
+
+    def _save_state(self):
+        try:
+            self.fs.save_state()
+        except Exception as e:
+            logging.warning("Failed save state of {}, {}".format(self.fs.name, e))
+
+    def _pick(self, user):
+        # with self.lock, 希少なchunkから、無ければ遅いpeerに割り当て済みのchunk
+        skipped = list()
+        index = None
+        missing = self.missing.get(user, ())
+        while len(self.heap) > 0:
+            item = heapq.heappop(self.heap)
+            rarity, dummy, check = item
+            if check not in self.pending or -rarity != self.rarity[check]:
+                continue  # 取得済み、古いentry
+            if self.fs.f_contain[check]:
+                self.pending.discard(check)  # swarmの外で取得された
+                continue
+            if check in missing:
+                skipped.append(item)
+                continue
+            index = check
+            break
+        for item in skipped:
+            heapq.heappush(self.heap, item)
+        if index is not None:
+            self.pending.discard(index)
+            return index, False
+        # 遅れているchunkを重複して要求する
+        now = time.time()
+        for check, users in self.assigned.items():
+            if user in users or check in missing:
+                continue
+            if all(now - start > self._expected(user_) for user_, start in users.items()):
+                return check, True
+        return None, False
+
+    def _refresh(self):
+        # with self.lock, ShareReaderなどswarmの外で取得されたchunkを取得済みとして数える
+        for index in [index for index in self.pending if self.fs.f_contain[index]]:
+            self.pending.discard(index)
+        for index in [index for index in self.assigned if self.fs.f_contain[index]]:
+            del self.assigned[index]
+        self.done = sum(1 for f in self.fs.f_contain if f)
+        if self.is_complete():
+            self.event.set()
+
+    def _pickable(self, user):
+        # with self.lock, workerを動かす意味があるか
+        if self.peers[user]['streak'] >= self.fail_limit:
+            return False
+        missing = self.missing.get(user, ())
+        return any(index not in missing for index in self.pending)
+
+    def _expected(self, user):
+        # with self.lock
+        rate = self.peers[user]['rate'] if user in self.peers else None
+        if not rate:
+            return self.min_slow * 5
+        return max(self.min_slow, self.slow_factor * C.MAX_RECEIVE_SIZE / rate)
+
+    def _worker(self, user):
+        stat = self.peers[user]
+        try:
+            while not self.f_stop:
+                with self.lock:
+                    index, f_duplicate = self._pick(user)
+                    if index is None:
+                        if len(self.pending) + len(self.assigned) == 0:
+                            return  # 全て取得した
+                        f_wait = len(self.assigned) > 0
                     else:
-                        logging.info("Failed %d=0x%s" % (i, hex_hash))
-                        import traceback
-                        traceback.print_exc()
-                        allow_fail -= 1
-                        break
+                        self.assigned.setdefault(index, dict())[user] = time.time()
+                        stat['inflight'] += 1
+                if index is None:
+                    if not f_wait:
+                        return  # このpeerに頼めるchunkが無い
+                    time.sleep(0.5)
+                    continue
+                if f_duplicate:
+                    self.progress('slow', index, user)
+                self._fetch(index, user, stat)
+                if stat['streak'] >= self.fail_limit or user not in self.pc.p2p.user:
+                    return
+        finally:
+            with self.lock:
+                stat['workers'] -= 1
+
+    def _fetch(self, index, user, stat):
+        file_hash = self.hashes[index]
+        start = time.time()
+        f_missing = False
+        try:
+            raw = self.pc.request_file(file_hash, user)
+        except (FileReceiveError, TimeoutError, ConnectionError, PeerToPeerError) as e:
+            raw = None
+            f_missing = isinstance(e, FileReceiveError)  # timeoutなら次も頼む
+            logging.debug("Failed %d=0x%s from %s, %s" % (index, file_hash, user.name, e))
+        elapsed = max(time.time() - start, 1e-6)
+        with self.lock:
+            stat['inflight'] -= 1
+            users = self.assigned.get(index, dict())
+            users.pop(user, None)
+            if raw is None:
+                stat['fail'] += 1
+                stat['streak'] += 1
+                if f_missing:
+                    self._set_have(user, [index], False)
+                if len(users) == 0:
+                    self.assigned.pop(index, None)
+                    if not self.fs.f_contain[index]:
+                        self.pending.add(index)
+                        heapq.heappush(self.heap, (-self.rarity[index], random.random(), index))
+            else:
+                stat['success'] += 1
+                stat['streak'] = 0
+                stat['bytes'] += len(raw)
+                rate = len(raw) / elapsed
+                stat['rate'] = rate if stat['rate'] is None else stat['rate'] * 0.7 + rate * 0.3
+                self.assigned.pop(index, None)  # 重複して要求中のpeerの結果は捨てる
+                if self.fs.f_contain[index]:
+                    self._refresh()  # ShareReader等が先に取得した
+                    return
+                self.fs.f_contain[index] = True
+                self.done += 1
+                self.size += len(raw)
+                if self.is_complete():
+                    self.event.set()
+        if raw is None:
+            self.progress('fail', index, user)
+        else:
+            self.progress('chunk', index, user, rate=stat['rate'])
+
+
+class ShareReader(io.RawIOBase):
+    """
+    FileShare.open() が返すfile-like object
+    読み出し位置のchunkを必要になった時に取得し、後ろのchunkを並列に先読みする
+    メモリに置くのは最大cache個のchunkだけ
+    """
+    def __init__(self, fs, pwd=None, read_ahead=4, cache=8):
+        super().__init__()
+        self.fs = fs
+        self.pwd = pwd
+        self.read_ahead = read_ahead
+        self.limit = max(cache, read_ahead + 1)
+        self.offsets = fs.chunk_offsets()
+        self.size = self.offsets[-1]
+        self.position = 0
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()  # {index: plain chunk} LRU
+        self.fetching = dict()  # {index: Event}
+        self.errors = collections.OrderedDict()  # {index: exception} 読まれなかった先読みの失敗は古い順に捨てる
+
+    def __repr__(self):
+        return "<ShareReader {} {}/{}>".format(self.fs.name, self.position, self.size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('invalid whence {}'.format(whence))
+        if position < 0:
+            raise ValueError('negative seek position {}'.format(position))
+        self.position = position
+        return position
+
+    def read(self, size=-1):
+        # chunkをまたいでもsize分まで読む
+        if size is None or size < 0:
+            size = max(0, self.size - self.position)
+        result = list()
+        while size > 0:
+            piece = self._read_piece(size)
+            if len(piece) == 0:
+                break
+            result.append(bytes(piece))
+            size -= len(piece)
+        return b''.join(result)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        piece = self._read_piece(len(b))
+        b[:len(piece)] = piece
+        return len(piece)
+
+    def _read_piece(self, size):
+        # return memoryview, 読み出し位置のchunkから最大size分
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self.position >= self.size:
+            return memoryview(b'')
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        chunk = memoryview(self._get(index))
+        start = self.position - self.offsets[index]
+        piece = chunk[start:start + size]
+        self.position += len(piece)
+        return piece
+
+    def close(self):
+        with self.lock:
+            self.cache.clear()
+            self.errors.clear()
+        super().close()
+
+    def _get(self, index):
+        # 先読みを始めてからindexのchunkを待つ
+        for i in range(index, min(index + self.read_ahead + 1, len(self.offsets) - 1)):
+            self._prefetch(i)
+        while True:
+            with self.lock:
+                if index in self.cache:
+                    self.cache.move_to_end(index)
+                    return self.cache[index]
+                if index in self.errors:
+                    raise self.errors.pop(index)
+                event = self.fetching.get(index)
+            if event is None:
+                self._prefetch(index)
+            else:
+                event.wait()
+
+    def _prefetch(self, index):
+        with self.lock:
+            if index in self.cache or index in self.fetching:
+                return
+            self.fetching[index] = threading.Event()
+        threading.Thread(target=self._fetch, args=(index,), name='Reader', daemon=True).start()
 
+    def _fetch(self, index):
+        chunk = error = None
+        try:
+            chunk = self.fs.read_chunk(index, self.pwd)
+        except Exception as e:
+            error = e
+        with self.lock:
+            if error is not None:
+                self.errors[index] = error
+                while len(self.errors) > self.limit:
+                    self.errors.popitem(last=False)
+            elif not self.closed:
+                self.cache[index] = chunk
+                while len(self.cache) > self.limit:
+                    self.cache.popitem(last=False)
+            self.fetching.pop(index).set()
@@ -1,12 +1,19 @@
 from threading import Thread, Lock
 import queue
 import copy
+import heapq
+import bisect
+import collections
 import time
 import random
 import bjson
 import atexit
 import logging
+import math
+import statistics
 import os
+import zlib
+from hashlib import sha256
 
 # For AES
 from Cryptodome.Cipher import AES
@@ -14,39 +21,101 @@ from Cryptodome import Random
 from base64 import b64encode, b64decode
 
 
-class StackDict:
-    def __init__(self, limit=500):
-        self.uuid2data = dict()
+class LRUCache:
+    """
+    thread safeなLRU/TTLキャッシュ、put/get/evictはO(1)
+    max_bytesを指定するとbytesの合計サイズでも制限する
+    """
+    def __init__(self, limit=500, expire=None, max_bytes=None):
+        self.data = collections.OrderedDict()  # {uuid: (item, time, size)}
         self.lock = Lock()
         self.limit = limit
+        self.expire = expire
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hit = 0
+        self.miss = 0
+        self.evicted = 0
+        self.expired = 0
 
     def get(self, uuid):
-        return self.uuid2data[uuid][0]
-
-    def put(self, uuid, item):
         with self.lock:
-            self.uuid2data[uuid] = (item, time.time())
-            if len(self.uuid2data) > self.limit:
-                self.__refresh()
+            if uuid not in self.data:
+                self.miss += 1
+                raise KeyError(uuid)
+            item, time_, size = self.data[uuid]
+            if self.expire and time_ < time.time() - self.expire:
+                self.__delete(uuid)
+                self.expired += 1
+                self.miss += 1
+                raise KeyError(uuid)
+            self.data.move_to_end(uuid)
+            self.hit += 1
+            return item
+
+    def put(self, uuid, item, size=None):
+        if size is None:
+            size = len(item) if isinstance(item, (bytes, bytearray)) else 0
+        with self.lock:
+            if uuid in self.data:
+                self.__delete(uuid)
+            self.data[uuid] = (item, time.time(), size)
+            self.size += size
+            self.__evict()
 
     def include(self, uuid):
-        return uuid in self.uuid2data
+        with self.lock:
+            if uuid not in self.data:
+                return False
+            if self.expire and self.data[uuid][1] < time.time() - self.expire:
+                self.__delete(uuid)
+                self.expired += 1
+                return False
+            return True
 
     def remove(self, uuid):
         with self.lock:
-            if uuid in self.uuid2data:
-                del self.uuid2data[uuid]
-
-    def __refresh(self):
-        limit = self.limit * 3 // 4
-        for k, v in sorted(self.uuid2data.items(), key=lambda x: x[1][1]):
-            del self.uuid2data[k]
-            if len(self.uuid2data) < limit:
+            if uuid in self.data:
+                self.__delete(uuid)
+
+    def __delete(self, uuid):
+        item, time_, size = self.data.pop(uuid)
+        self.size -= size
+
+    def __evict(self):
+        # 古い順に消す、先頭が期限切れなら続けて消す
+        while len(self.data) > 0:
+            uuid, (item, time_, size) = next(iter(self.data.items()))
+            if len(self.data) > self.limit or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                self.evicted += 1
+            elif self.expire and time_ < time.time() - self.expire:
+                self.expired += 1
+            else:
                 break
-        logging.debug("StackDict refresh now.")
+            self.__delete(uuid)
 
     def get_data_list(self):
-        return list(self.uuid2data.values())
+        with self.lock:
+            return [item for item, time_, size in self.data.values()]
+
+    def getinfo(self):
+        return {
+            'length': len(self.data),
+            'size': self.size,
+            'hit': self.hit,
+            'miss': self.miss,
+            'evicted': self.evicted,
+            'expired': self.expired}
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, uuid):
+        return self.include(uuid)
+
+
+StackDict = LRUCache  # old name
 
 
 class QueueSystem:
@@ -263,6 +332,27 @@ class AESCipher:
         cipher = AES.new(key, AES.MODE_CBC, iv)
         return iv + cipher.encrypt(raw)
 
+    @staticmethod
+    def encrypt_frame(key, *parts):
+        # return length(4bytes) + encrypt(b''.join(parts))
+        # partsは連結せずframeに1回だけコピーし、その場で暗号化する
+        key = b64decode(key.encode())
+        size = sum(len(part) for part in parts)
+        pad = AES.block_size - size % AES.block_size
+        length = AES.block_size + size + pad
+        frame = bytearray(4 + length)
+        frame[:4] = length.to_bytes(4, 'big')
+        iv = Random.new().read(AES.block_size)
+        frame[4:4 + AES.block_size] = iv
+        position = 4 + AES.block_size
+        for part in parts:
+            frame[position:position + len(part)] = part
+            position += len(part)
+        frame[position:] = pad.to_bytes(1, 'big') * pad
+        view = memoryview(frame)[4 + AES.block_size:]
+        AES.new(key, AES.MODE_CBC, iv).encrypt(view, output=view)
+        return frame
+
     @staticmethod
     def decrypt(key, enc):
         assert type(enc) == bytes, 'Encrypt data is bytes'
@@ -342,5 +432,591 @@ class JsonDataBase:
         return None
 
 
+class PeerStore:
+    """
+    JsonDataBaseと同じように扱えるpeer表、変更をappend-onlyのlogに逐次書き込む
+    record = len(4bytes) + bjson((op, host_port, value))
+    """
+    def __init__(self, path, remove_limit=3, limit=1000, legacy_path=None, f_sync=False):
+        self.remove_limit = remove_limit
+        self.limit = limit  # 保持するpeerの最大数
+        self.path = path
+        self.f_sync = f_sync  # fsync each record
+        self.data = dict()  # {host_port: header}
+        self.stats = dict()  # {host_port: {'success', 'fail', 'streak', 'last', 'uptime', 'rtt'}}
+        self.lock = Lock()
+        self.records = 0
+        self.fp = None
+        self.on_put = list()  # [function(host_port),..]
+        self.on_remove = list()  # [function(host_port),..]
+        self.load()
+        if legacy_path and len(self.data) == 0 and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+        atexit.register(self.close)
+
+    def load(self):
+        # 壊れた末尾のrecordは切り捨てる
+        self.data.clear()
+        self.stats.clear()
+        self.records = 0
+        good = 0
+        if os.path.exists(self.path):
+            with open(self.path, mode='br') as fp:
+                while True:
+                    prefix = fp.read(4)
+                    if len(prefix) < 4:
+                        break
+                    raw = fp.read(int.from_bytes(prefix, 'big'))
+                    try:
+                        op, host_port, value = bjson.loads(raw)
+                    except Exception:
+                        break
+                    self.__apply(op, tuple(host_port), value)
+                    self.records += 1
+                    good = fp.tell()
+            if good < os.path.getsize(self.path):
+                logging.warning("PeerStore truncate broken tail of {}".format(os.path.split(self.path)[1]))
+                with open(self.path, mode='ba') as fp:
+                    fp.truncate(good)
+        self.fp = open(self.path, mode='ba')
+        logging.info("PeerStore load {} peers from {}".format(len(self.data), os.path.split(self.path)[1]))
+
+    def migrate(self, legacy_path):
+        # JsonDataBaseの形式から移行する
+        try:
+            with open(legacy_path, mode='br') as fp:
+                for host_port, header in bjson.load(fp=fp).items():
+                    self[tuple(host_port)] = header
+            logging.info("PeerStore migrate {} peers from {}".format(len(self.data), legacy_path))
+        except Exception as e:
+            logging.debug("Failed migrate peers, {}".format(e))
+
+    def save(self):
+        # 全体を書き直して古いrecordを捨てる
+        with self.lock:
+            self.__compact()
+        logging.info("PeerStore saved to {}".format(os.path.split(self.path)[1]))
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.save()
+        with self.lock:
+            self.fp.close()
+            self.fp = None
+
+    def __apply(self, op, host_port, value):
+        if op == 'put':
+            self.data[host_port] = value
+            if host_port not in self.stats:
+                self.stats[host_port] = self.new_stat()
+        elif op == 'stat':
+            if host_port in self.data:
+                self.stats[host_port] = value
+        elif op == 'del':
+            self.data.pop(host_port, None)
+            self.stats.pop(host_port, None)
+
+    def __write(self, op, host_port, value):
+        # with self.lock
+        self.__apply(op, host_port, value)
+        for function in (self.on_put if op == 'put' else self.on_remove if op == 'del' else ()):
+            function(host_port)
+        if self.fp is None:
+            return
+        raw = bjson.dumps((op, host_port, value), compress=False)
+        self.fp.write(len(raw).to_bytes(4, 'big') + raw)
+        self.fp.flush()
+        if self.f_sync:
+            os.fsync(self.fp.fileno())
+        self.records += 1
+        if self.records > max(100, len(self.data) * 4):
+            self.__compact()
+
+    def __compact(self):
+        # with self.lock
+        if self.fp is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='bw') as fp:
+            for host_port, header in self.data.items():
+                for op, value in (('put', header), ('stat', self.stats[host_port])):
+                    raw = bjson.dumps((op, host_port, value), compress=False)
+                    fp.write(len(raw).to_bytes(4, 'big') + raw)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.fp.close()
+        os.replace(tmp_path, self.path)
+        self.fp = open(self.path, mode='ba')
+        self.records = len(self.data) * 2
+
+    @staticmethod
+    def new_stat():
+        return {
+            'success': 0,  # 接続成功数
+            'fail': 0,  # 接続失敗数
+            'streak': 0,  # 連続した接続失敗数
+            'last': 0,  # 最後に接続していた時刻
+            'uptime': 0,  # 接続していた合計時間
+            'rtt': list()}  # 最近のRTT
+
+    def quality(self, host_port):
+        # 接続成功率、接続時間が高く、RTTが短く、最近見たpeerほど高い
+        stat = self.stats.get(host_port)
+        if stat is None:
+            return 0.0
+        rate = (stat['success'] + 1) / (stat['success'] + stat['fail'] + 2)
+        uptime = 1 + math.log1p(stat.get('uptime', 0) / 60)
+        rtt = self.median_rtt(host_port)
+        rtt = 1.0 if rtt is None else rtt
+        age = max(0, time.time() - stat['last']) if stat['last'] else 3600 * 24 * 30
+        return rate * uptime / (1 + rtt) / (1 + age / 3600 / 24)
+
+    def median_rtt(self, host_port):
+        stat = self.stats.get(host_port)
+        if stat is None or len(stat.get('rtt', ())) == 0:
+            return None
+        return statistics.median(stat['rtt'])
+
+    def ranking(self, check=None):
+        # 質の高い順に並べる
+        with self.lock:
+            host_ports = [host_port for host_port in self.data if check is None or check(host_port)]
+            return sorted(host_ports, key=self.quality, reverse=True)
+
+    def get_streak(self, host_port):
+        stat = self.stats.get(host_port)
+        return stat.get('streak', 0) if stat else 0
+
+    def put_success(self, host_port):
+        with self.lock:
+            stat = self.__copy_stat(host_port)
+            if stat is None:
+                return
+            stat['success'] += 1
+            stat['streak'] = 0
+            stat['last'] = int(time.time())
+            self.__write('stat', host_port, stat)
+
+    def put_fail(self, host_port):
+        with self.lock:
+            stat = self.__copy_stat(host_port)
+            if stat is None:
+                return
+            stat['fail'] += 1
+            stat['streak'] = stat.get('streak', 0) + 1
+            self.__write('stat', host_port, stat)
+
+    def put_session(self, host_port, uptime, rtt=None):
+        # 切断時に接続していた時間とRTTを記録する
+        with self.lock:
+            stat = self.__copy_stat(host_port)
+            if stat is None:
+                return
+            stat['uptime'] = stat.get('uptime', 0) + int(uptime)
+            stat['last'] = int(time.time())
+            if rtt is not None:
+                stat['rtt'] = (list(stat.get('rtt', ())) + [round(rtt, 4)])[-9:]
+            self.__write('stat', host_port, stat)
+
+    def __copy_stat(self, host_port):
+        # with self.lock
+        if host_port not in self.data:
+            return None
+        stat = self.new_stat()
+        stat.update(self.stats[host_port])
+        return stat
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def copy(self):
+        with self.lock:
+            return dict(self.data)
+
+    def remove(self, host_port):
+        with self.lock:
+            if host_port in self.data and \
+                    len(self.data) >= self.remove_limit:
+                self.__write('del', host_port, None)
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, item):
+        return item in self.data
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if self.data.get(key) == value:
+                return  # no change
+            if key not in self.data and len(self.data) >= self.limit:
+                # 一番質の悪いpeerを追い出す
+                worst = min(self.data, key=self.quality)
+                self.__write('del', worst, None)
+            self.__write('put', key, value)
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.data:
+                return self.data[key]
+        return None
+
+
+class ScoreIndex:
+    """
+    stabilize用のpeerスコア索引、接続・切断・GET_NEARSの差分だけで更新する
+    score = 隣接ノードに知られている数(第二層は加点) - 既接続(第一層は減点) - RTT * latency_weight
+    """
+    def __init__(self, latency_weight=0):
+        self.latency_weight = latency_weight
+        self.lock = Lock()
+        self.in_peers = set()  # peer表にある
+        self.connected = set()  # 第一層
+        self.count = dict()  # {host_port: 第二層として数えられた数}
+        self.rtt = dict()  # {host_port: EWMA rtt}
+        self.score = dict()  # {host_port: score}
+        self.version = dict()  # {host_port: heap entry number}
+        self.high = list()  # heap [(-score, number, host_port),..]
+        self.number = 0
+
+    def __len__(self):
+        return len(self.score)
+
+    def __contains__(self, host_port):
+        return host_port in self.score
+
+    def add_peer(self, host_port):
+        with self.lock:
+            self.in_peers.add(host_port)
+            self.__update(host_port)
+
+    def remove_peer(self, host_port):
+        with self.lock:
+            self.in_peers.discard(host_port)
+            self.__update(host_port)
+
+    def connect(self, host_port):
+        with self.lock:
+            self.connected.add(host_port)
+            self.__update(host_port)
+
+    def disconnect(self, host_port):
+        with self.lock:
+            self.connected.discard(host_port)
+            self.__update(host_port)
+
+    def update_neers(self, old, new):
+        # 隣接ノードのneersの差分だけ数え直す
+        old, new = set(old), set(new)
+        with self.lock:
+            for host_port in old - new:
+                self.count[host_port] = self.count.get(host_port, 1) - 1
+                if self.count[host_port] <= 0:
+                    del self.count[host_port]
+                self.__update(host_port)
+            for host_port in new - old:
+                self.count[host_port] = self.count.get(host_port, 0) + 1
+                self.__update(host_port)
+
+    def set_rtt(self, host_port, rtt):
+        if rtt is None:
+            return
+        with self.lock:
+            self.rtt[host_port] = rtt
+            self.__update(host_port)
+
+    def calc_score(self, host_port):
+        score = self.count.get(host_port, 0)
+        if host_port in self.connected:
+            score -= 1
+        if host_port in self.rtt:
+            score -= self.rtt[host_port] * self.latency_weight
+        return score
+
+    def __update(self, host_port):
+        # with self.lock
+        if host_port not in self.in_peers and host_port not in self.connected \
+                and host_port not in self.count:
+            if host_port in self.score:
+                del self.score[host_port]
+                del self.version[host_port]
+                self.rtt.pop(host_port, None)
+            return
+        score = self.calc_score(host_port)
+        if self.score.get(host_port) == score:
+            return
+        self.number += 1
+        self.score[host_port] = score
+        self.version[host_port] = self.number
+        heapq.heappush(self.high, (-score, self.number, host_port))
+        if len(self.high) > len(self.score) * 2 + 100:
+            # 古いentryを捨てて作り直す
+            self.high = [(-score, self.version[host_port], host_port)
+                         for host_port, score in self.score.items()]
+            heapq.heapify(self.high)
+
+    def rescore(self):
+        # calc_scoreの外部要因が変わった時に全体を計算し直す
+        with self.lock:
+            for host_port in list(self.score):
+                self.__update(host_port)
+
+    def top(self, k, check=None):
+        # スコア上位k件、checkがFalseのものは除く
+        result = list()
+        popped = list()
+        with self.lock:
+            while len(result) < k and len(self.high) > 0:
+                entry = heapq.heappop(self.high)
+                score, number, host_port = entry
+                if self.version.get(host_port) != number:
+                    continue  # old entry
+                popped.append(entry)
+                if check is None or check(host_port):
+                    result.append((host_port, -score))
+            for entry in popped:
+                heapq.heappush(self.high, entry)
+        return result
+
+    def sample(self, check=None, retry=10):
+        # 索引からランダムに1件選ぶ
+        with self.lock:
+            for i in range(retry):
+                if len(self.high) == 0:
+                    break
+                score, number, host_port = random.choice(self.high)
+                if self.version.get(host_port) != number:
+                    continue
+                if check is None or check(host_port):
+                    return host_port, -score
+        return None
+
+    def bottom(self, host_ports, k):
+        # 指定したpeerの中からスコア下位k件
+        with self.lock:
+            return heapq.nsmallest(k, ((host_port, self.score.get(host_port, 0)) for host_port in host_ports),
+                                   key=lambda x: x[1])
+
+
+class VersionTable:
+    """
+    peer表の変更に番号を付け、要求元が最後に見たversion以降の差分だけを返す
+    request => None(旧形式) or {'epoch': epoch, 'version': version, 'page': 続きのcursor}
+    response => {'epoch', 'version', 'full', 'add': {key: value,..}, 'remove': [key,..], 'page'}
+    全件がlimitを超える時はkeyの順にlimit件ずつ送り、'page'で続きを要求させる
+    """
+    def __init__(self, limit=200, history=2000):
+        self.limit = limit  # 一度に返す最大数、超えたら何回かに分けて返す
+        self.history = history  # 覚えておく変更の数
+        self.epoch = random.randint(1, 0xffffffff)  # 再起動したら全件を送り直す
+        self.version = 0
+        self.oldest = 0  # これより古いversionからの差分は作れない
+        self.changes = collections.OrderedDict()  # {key: version} 古い順
+        self.lock = Lock()
+
+    def touch(self, key):
+        with self.lock:
+            self.version += 1
+            self.changes.pop(key, None)
+            self.changes[key] = self.version
+            if len(self.changes) > self.history:
+                _, self.oldest = self.changes.popitem(last=False)
+
+    def changed_since(self, version):
+        # with self.lock, 新しい順にたどるので差分の大きさに比例する
+        keys = list()
+        for key in reversed(self.changes):
+            if self.changes[key] <= version:
+                break
+            keys.append(key)
+        return keys
+
+    def paging(self, data, cursor, version, f_full):
+        # 全件をkeyの順にlimit件ずつ返す、cursorは前回返した最後のkey
+        # 途中で追加されたkeyもcursorより後なら拾え、前なら後で差分として送られる
+        keys = sorted((str(key), key) for key in data if cursor is None or str(key) > cursor)
+        page = keys[:self.limit]
+        return {'epoch': self.epoch, 'version': version, 'full': f_full,
+                'add': {key: data[key] for dummy, key in page}, 'remove': list(),
+                'page': page[-1][0] if len(keys) > self.limit else None}
+
+    def diff(self, request, get_data):
+        """ get_data => function return {key: value,..} """
+        with self.lock:
+            version = self.version
+            try:
+                f_full = request['epoch'] != self.epoch or request['version'] < self.oldest
+                cursor = None if f_full else request.get('page')
+                keys = None if f_full or cursor is not None else self.changed_since(request['version'])
+            except (TypeError, KeyError, AttributeError):
+                keys = cursor = None
+        # versionを読んでからdataを取るので、取りこぼしは無く重複は次回も送られるだけ
+        data = get_data()
+        if request is None:
+            return data  # 旧形式は全件
+        elif cursor is not None:
+            # 全件の続き、versionは送り始めた時のままにして、その間の変更は後で差分で送る
+            return self.paging(data, cursor, request['version'], False)
+        elif keys is None or len(keys) > self.limit:
+            return self.paging(data, None, version, True)
+        else:
+            return {'epoch': self.epoch, 'version': version, 'full': False,
+                    'add': {key: data[key] for key in keys if key in data},
+                    'remove': [key for key in keys if key not in data], 'page': None}
+
+    @staticmethod
+    def apply(old, response):
+        """ return (new dict, request for next time) """
+        if not isinstance(response, dict) or 'epoch' not in response:
+            return response, None  # 旧形式は全件
+        if response['full']:
+            new = dict(response['add'])
+        else:
+            new = dict(old)
+            new.update(response['add'])
+            for key in response['remove']:
+                new.pop(key, None)
+        request = {'epoch': response['epoch'], 'version': response['version']}
+        if response.get('page') is not None:
+            request['page'] = response['page']  # 全件の続きを要求する
+        return new, request
+
+
+class MerkleTree:
+    """
+    chunk hashのMerkle tree、rootだけでchunk一覧と各chunkを検証できる
+    leaf = sha256(0x00 + chunk hash), node = sha256(0x01 + left + right)
+    奇数個の最後のnodeは複製せずにそのまま上の段に上げる
+    root = sha256(0x02 + chunk数(8bytes) + 最上段のnode) chunk数も含めて検証する
+    """
+    def __init__(self, leaves):
+        self.total = len(leaves)
+        self.levels = [[sha256(b'\x00' + leaf).digest() for leaf in leaves]]
+        while len(self.levels[-1]) > 1:
+            prev = self.levels[-1]
+            self.levels.append([self.hash_node(prev[i], prev[i + 1]) if i + 1 < len(prev) else prev[i]
+                                for i in range(0, len(prev), 2)])
+
+    @property
+    def root(self):
+        top = self.levels[-1][0] if self.total > 0 else b''
+        return self.hash_root(self.total, top)
+
+    @staticmethod
+    def hash_root(total, top):
+        return sha256(b'\x02' + total.to_bytes(8, 'big') + top).digest()
+
+    @staticmethod
+    def hash_node(left, right):
+        return sha256(b'\x01' + left + right).digest()
+
+    def proof(self, index):
+        # return [sibling hash,..] 下の段から
+        path = list()
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                path.append(level[sibling])
+            index //= 2
+        return path
+
+    @staticmethod
+    def verify(leaf, index, total, proof, root):
+        # leaf => chunk hash, index番目のchunkがrootに含まれるか
+        if not 0 <= index < total:
+            return False
+        node = sha256(b'\x00' + leaf).digest()
+        proof = list(proof)
+        width = total
+        while width > 1:
+            sibling = index ^ 1
+            if sibling < width:
+                if len(proof) == 0:
+                    return False
+                other = proof.pop(0)
+                node = MerkleTree.hash_node(other, node) if index & 1 else MerkleTree.hash_node(node, other)
+            index //= 2
+            width = (width + 1) // 2
+        return len(proof) == 0 and MerkleTree.hash_root(total, node) == root
+
+
+def index2bitfield(indexes, total):
+    # bit i (先頭byteの最上位bitから) が立っていればi番目のchunkを持っている
+    bitfield = bytearray((total + 7) // 8)
+    for index in indexes:
+        bitfield[index // 8] |= 0x80 >> (index % 8)
+    return bytes(bitfield)
+
+
+def bitfield2index(bitfield, total):
+    return [index for index in range(min(total, len(bitfield) * 8))
+            if bitfield[index // 8] & (0x80 >> (index % 8))]
+
+
+# content-defined chunking, 各byteを0/1に写し直近のbyte列が決まったpatternになった所で切る
+# translateとfindで探すのでbyte毎にpythonを回さない, 同じ内容なら位置がずれても同じ所で切れる
+CDC_TABLE = bytes(sha256(bytes((i,))).digest()[0] >> 7 for i in range(256))
+CDC_PATTERN = bytes(bit >> 7 & 1 for bit in sha256(b'cdc pattern').digest())
+
+
+def cdc_patterns(avg_size):
+    # normalized chunking, avg未満は厳しいpattern, avg以上は緩いpattern (厳しい方の末尾が緩い方)
+    bits = min(max(3, round(math.log2(avg_size))), len(CDC_PATTERN) - 1)
+    strict = CDC_PATTERN[-(bits + 1):]
+    return strict, strict[2:]
+
+
+def cdc_candidates(raw, avg_size, segment=16000000):
+    """
+    rawで切れる位置の候補を返す [(position, f_strict),..]
+    position => 直前までが1chunk, rawはmmapでもよく、segment毎にcopyする
+    """
+    strict, loose = cdc_patterns(avg_size)
+    result = list()
+    for start in range(0, len(raw), segment):
+        base = max(0, start - len(strict) + 1)  # segmentを跨ぐpattern用に重ねる
+        piece = raw[base:start + segment].translate(CDC_TABLE)
+        index = piece.find(loose, start - base - len(loose) + 1 if start else 0)
+        while index >= 0:
+            f_strict = index >= 2 and piece[index - 2:index + len(loose)] == strict
+            result.append((base + index + len(loose), f_strict))
+            index = piece.find(loose, index + 1)
+    return result
+
+
+def cdc_boundaries(candidates, size, min_size, avg_size, max_size):
+    """
+    候補とmin/avg/maxから切る位置を決める, return [end of chunk,..] 最後はsize
+    candidates => position順のcdc_candidates
+    """
+    positions = [position for position, _ in candidates]
+    boundaries = list()
+    start = 0
+    while start < size:
+        end = min(start + max_size, size)
+        i = bisect.bisect_left(positions, start + min_size)
+        while i < len(positions) and positions[i] < end:
+            position, f_strict = candidates[i]
+            if f_strict or position >= start + avg_size:
+                end = position
+                break
+            i += 1
+        boundaries.append(end)
+        start = end
+    return boundaries
+
+
+def is_compressible(raw, sample=4096, ratio=0.9):
+    # 先頭だけ軽く圧縮してみる、暗号化・圧縮済みのchunkはzlibを通さない
+    head = bytes(raw[:sample])
+    return len(head) > 0 and len(zlib.compress(head, 1)) < len(head) * ratio
+
+
 def version2int(v):
     return sum([pow(1000, i) * int(d) for i, d in enumerate(reversed(v.split('.')))])
\ No newline at end of file
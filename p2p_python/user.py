@@ -1,7 +1,56 @@
 from .config import C, V, PeerToPeerError
+from .tool.utils import AESCipher
 import time
 import socket
-from threading import Lock
+import heapq
+import logging
+import itertools
+import collections
+from threading import Thread, Lock, Condition
+
+# stream frame flags
+F_FIN = 0x01  # last fragment of the stream
+F_WINDOW = 0x02  # flow control, payload is window increment
+F_RAW = 0x04  # body is not compressed
+F_CHUNK = 0x08  # chunk transfer, body is header length(4bytes) + header + chunk
+
+
+class Stream:
+    """
+    送信中の論理stream、fragmentに分けて他のstreamと交互に送る
+    bodyはbytesかbufferのlist、mmapのsliceなどをコピーせずに持つ
+    """
+    def __init__(self, stream_id, body, priority, flags=0):
+        self.stream_id = stream_id
+        self.parts = [memoryview(part) for part in (body if isinstance(body, list) else [body])]
+        self.size = sum(len(part) for part in self.parts)
+        self.priority = priority
+        self.flags = flags
+        self.offset = 0
+        self.part_index = self.part_offset = 0
+        self.window = C.STREAM_WINDOW
+
+    def pop_fragment(self):
+        # return flags, [buffer,..] partsの境界をまたぐfragmentはlistで返す
+        size = min(C.FRAGMENT_SIZE, self.window, self.size - self.offset)
+        self.offset += size
+        self.window -= size
+        fragment = list()
+        while size > 0:
+            part = self.parts[self.part_index]
+            piece = part[self.part_offset:self.part_offset + size]
+            fragment.append(piece)
+            size -= len(piece)
+            self.part_offset += len(piece)
+            if self.part_offset >= len(part):
+                self.part_index += 1
+                self.part_offset = 0
+        if self.is_finished():
+            return self.flags | F_FIN, fragment
+        return self.flags, fragment
+
+    def is_finished(self):
+        return self.offset >= self.size
 
 
 class User:
@@ -12,21 +61,45 @@ class User:
         self.p2p_accept = None
         self.p2p_udp_accept = None
         self.p2p_port = None
+        self.p2p_mux = False
+        self.p2p_chunk = False
+        self.p2p_dht = False
         self.start_time = None
+        self.connect_time = time.time()
         self.number = number
         self.sock = sock
         self.host_port = host_port
         self.aeskey = aeskey
         self.sock_type = sock_type
         self.neers = dict()
+        self.neers_version = None  # GET_NEARSで最後に受け取ったversion
         self.warn = 0
+        self.rtt = None  # EWMA of round trip time (sec)
+        self.inflight = 0  # 応答待ちのrequest数
+        self.error_rate = 0.0  # EWMA of timeout
+        self.fail_streak = 0
+        self.breaker_count = 0  # 続けてcircuit breakerが開いた回数
+        self.breaker_until = 0.0  # この時刻まではpeerを選ばない
         self.lock = Lock()
+        self.stat_lock = Lock()  # inflight, error rate, breaker, 送信のlockとは分けて待たせない
+        self.send_cond = Condition()
+        self.send_que = list()  # heap [(priority, number, msg),..]
+        self.send_number = itertools.count()
+        self.streams = dict()  # {stream_id: Stream}
+        self.stream_order = collections.deque()  # round robin
+        self.stream_number = itertools.count(1)
+        self.f_sending = False
+        self.f_closed = False
+        self.on_send_error = None  # function(user, reason) 送信スレッドで失敗した時、Core.remove_connection
 
     def __repr__(self):
         return "<User {} {}s {} warn={}>"\
             .format(self.name, int(time.time())-self.start_time, (self.host_port[0], self.p2p_port), self.warn)
 
     def close(self):
+        with self.send_cond:
+            self.f_closed = True
+            self.send_cond.notify_all()  # stop sending thread
         try: self.sock.shutdown(socket.SHUT_RDWR)
         except: pass
         try: self.sock.close()
@@ -36,6 +109,105 @@ class User:
         with self.lock:
             self.sock.sendall(msg)
 
+    def send_by_priority(self, msg, priority=C.P_NORMAL):
+        # 優先度の高いframeから順に送信スレッドが送る
+        with self.send_cond:
+            self._wait_space(priority)
+            heapq.heappush(self.send_que, (priority, next(self.send_number), msg))
+            self._notify_sending()
+
+    def send_stream(self, body, priority=C.P_NORMAL, flags=0):
+        # 大きなbodyでも他のstreamをブロックしないようにfragmentで送る
+        with self.send_cond:
+            self._wait_space(priority)
+            stream = Stream(next(self.stream_number) & 0xffffffff, body, priority, flags)
+            self.streams[stream.stream_id] = stream
+            self.stream_order.append(stream)
+            self._notify_sending()
+        return stream.stream_id
+
+    def send_window(self, stream_id, increment):
+        frame = self.encode_frame(stream_id, F_WINDOW, [increment.to_bytes(4, 'big')])
+        self.send_by_priority(frame, C.P_HIGH)
+
+    def update_window(self, stream_id, increment):
+        with self.send_cond:
+            if stream_id in self.streams:
+                self.streams[stream_id].window += increment
+                self.send_cond.notify_all()
+
+    def encode_frame(self, stream_id, flags, fragment):
+        # fragment => [buffer,..]
+        head = stream_id.to_bytes(4, 'big') + flags.to_bytes(1, 'big')
+        return AESCipher.encrypt_frame(self.aeskey, head, *fragment)
+
+    def _wait_space(self, priority):
+        # with self.send_cond, 送信待ちが溢れていれば空くまで待つ、control frameは待たない
+        if priority != C.P_HIGH:
+            deadline = time.time() + C.SEND_QUE_TIMEOUT
+            while not self.f_closed and len(self.send_que) + len(self.streams) >= C.SEND_QUE_SIZE:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    raise ConnectionError('send queue of {} is full'.format(self.name))
+                self.send_cond.wait(remain)
+        if self.f_closed:
+            raise ConnectionAbortedError('already closed {}'.format(self.name))
+
+    def _notify_sending(self):
+        # with self.send_cond
+        self.send_cond.notify_all()
+        if not self.f_sending:
+            self.f_sending = True
+            Thread(target=self._sending, name='Send:{}'.format(self.name), daemon=True).start()
+
+    def _next_frame(self):
+        # with self.send_cond, return msg or (stream_id, flags, fragment) or None
+        priority = self.send_que[0][0] if len(self.send_que) > 0 else None
+        stream = None
+        for check in self.stream_order:
+            if check.window > 0 and (stream is None or check.priority < stream.priority):
+                stream = check
+        if stream is not None and (priority is None or stream.priority < priority):
+            flags, fragment = stream.pop_fragment()
+            self.stream_order.remove(stream)
+            if stream.is_finished():
+                del self.streams[stream.stream_id]
+            else:
+                self.stream_order.append(stream)
+            return stream.stream_id, flags, fragment
+        elif priority is not None:
+            return heapq.heappop(self.send_que)[2]
+        else:
+            return None
+
+    def _sending(self):
+        while True:
+            with self.send_cond:
+                frame = None
+                while not self.f_closed:
+                    f_full = len(self.send_que) + len(self.streams) >= C.SEND_QUE_SIZE
+                    frame = self._next_frame()
+                    if frame is not None:
+                        if f_full and len(self.send_que) + len(self.streams) < C.SEND_QUE_SIZE:
+                            self.send_cond.notify_all()  # _wait_spaceで待っている送信元を起こす
+                        break
+                    self.send_cond.wait()
+            if frame is None:
+                break
+            try:
+                if isinstance(frame, tuple):
+                    frame = self.encode_frame(*frame)
+                self.send(frame)
+            except Exception as e:
+                # 同期して送る時と同じように接続を切る
+                error = "Failed send to {}, {}".format(self.name, e)
+                logging.debug(error)
+                if self.on_send_error is None:
+                    self.close()
+                else:
+                    self.on_send_error(self, error)
+                break
+
     def getinfo(self):
         r = {
             'header': self.serialize(),
@@ -44,6 +216,7 @@ class User:
             'sock': str(self.sock),
             'host_port': self.host_port,
             'aeskey': self.aeskey,
+            'rtt': self.rtt,
             'sock_type': self.sock_type}
         return r
 
@@ -54,6 +227,9 @@ class User:
              'p2p_accept': self.p2p_accept,
              'p2p_udp_accept': self.p2p_udp_accept,
              'p2p_port': self.p2p_port,
+             'p2p_mux': self.p2p_mux,
+             'p2p_chunk': self.p2p_chunk,
+             'p2p_dht': self.p2p_dht,
              'start_time': self.start_time}
         return r
 
@@ -64,6 +240,9 @@ class User:
         self.p2p_accept = s['p2p_accept']
         self.p2p_udp_accept = s.get('p2p_udp_accept', False)
         self.p2p_port = s['p2p_port']
+        self.p2p_mux = s.get('p2p_mux', False)
+        self.p2p_chunk = s.get('p2p_chunk', False)
+        self.p2p_dht = s.get('p2p_dht', False)
         self.start_time = s['start_time']
 
     def get_host_port(self):
@@ -72,6 +251,47 @@ class User:
         host_port[1] = self.p2p_port
         return tuple(host_port)
 
+    def put_rtt(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt += C.RTT_ALPHA * (sample - self.rtt)
+
+    def add_inflight(self, n):
+        with self.stat_lock:
+            self.inflight += n
+
+    def put_result(self, f_success):
+        # 送ったrequestの成否からerror rateとcircuit breakerを更新する
+        with self.stat_lock:
+            self.error_rate += C.RTT_ALPHA * ((0.0 if f_success else 1.0) - self.error_rate)
+            if f_success:
+                self.fail_streak = self.breaker_count = 0
+                self.breaker_until = 0.0
+                return
+            self.fail_streak += 1
+            if self.fail_streak >= C.BREAKER_FAILS:
+                # 開いた後の最初のrequestが失敗すればすぐにまた開く(half-open)
+                self.breaker_count += 1
+                self.breaker_until = time.time() + C.BREAKER_TIME * 2 ** min(4, self.breaker_count - 1)
+                self.fail_streak = C.BREAKER_FAILS - 1
+
+    def is_available(self):
+        return time.time() >= self.breaker_until
+
+    def cost(self):
+        # 予想応答時間、小さいほど良い
+        rtt = self.rtt if self.rtt is not None else C.UNKNOWN_RTT
+        return rtt * (1 + self.inflight) * (1 + 4 * self.error_rate)
+
+    def health(self):
+        return {
+            'rtt': self.rtt,
+            'inflight': self.inflight,
+            'error_rate': round(self.error_rate, 3),
+            'breaker': max(0.0, round(self.breaker_until - time.time(), 1)),
+            'cost': self.cost()}
+
     def update_neers(self, items):
         # {(host,port): header, ..}
         self.neers = items